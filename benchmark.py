@@ -0,0 +1,249 @@
+import datetime
+import itertools
+import json
+import statistics
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
+from urllib.parse import urlencode
+
+import click
+from pymongo import monitoring
+
+RESULTS_DIR = Path("benchmark_results")
+
+
+class CommandCounter(monitoring.CommandListener):
+    # pymongo publishes command events on the thread that runs the operation, so a
+    # thread-local counter attributes every round trip to the request that caused it.
+    def __init__(self):
+        self.local = threading.local()
+
+    @property
+    def count(self) -> int:
+        return getattr(self.local, "count", 0)
+
+    def reset(self):
+        self.local.count = 0
+
+    def started(self, event):
+        self.local.count = self.count + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class Scenario(NamedTuple):
+    name: str
+    urls: list[str]
+
+
+class Sample(NamedTuple):
+    latency: float
+    queries: int
+    status: int
+
+
+def percentile(values: list[float], p: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def sample_ids(model, size: int, match: dict = None) -> list:
+    pipeline = [{"$match": match}] if match else []
+    pipeline += [{"$sample": {"size": size}}, {"$project": {"_id": 1}}]
+
+    return [document["_id"] for document in model.get_motor_collection().aggregate(pipeline)]
+
+
+def build_scenarios(size: int, rents: int) -> list[Scenario]:
+    from library.auth.models import User
+    from library.books.models import Book
+    from library.books.models import BookOrders
+
+    book_ids = sample_ids(Book, size)
+    user_ids = sample_ids(User, size)
+    authors = [
+        book["authors"][0]
+        for book in Book.get_motor_collection().find({"_id": {"$in": book_ids}}, {"authors": 1})
+    ]
+
+    # Every rent needs a copy on the shelf and a book the member does not have yet;
+    # returning the same pairs afterwards leaves the stock as it was.
+    pairs = list(zip(sample_ids(Book, rents, {"stock": {"$gt": 0}}), itertools.cycle(user_ids)))
+
+    return [
+        Scenario("list_books", ["/books"]),
+        Scenario(
+            "list_books_sorted",
+            [f"/books?{urlencode({'order_by': order.value})}" for order in BookOrders],
+        ),
+        Scenario(
+            "list_books_search",
+            [f"/books?{urlencode({'author': author})}" for author in authors],
+        ),
+        Scenario("book_detail", [f"/books/{book_id}" for book_id in book_ids]),
+        Scenario("member_list", ["/members"]),
+        Scenario("user_details", [f"/members/{user_id}" for user_id in user_ids]),
+        Scenario("overdue_returns", ["/returns/overdue"]),
+        Scenario("rent_book", [f"/books/{book}/rent/{user}" for book, user in pairs]),
+        Scenario("return_book", [f"/books/{book}/return/{user}" for book, user in pairs]),
+    ]
+
+
+def drive(app, counter, admin_id, urls, count: int, threads: int) -> tuple[list[Sample], float]:
+    # next() on a shared iterator is atomic under the GIL, so threads never repeat a URL
+    # of the rent and return scenarios, which are not repeatable.
+    urls = iter(urls)
+    samples = []
+
+    def worker(requests: int):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(admin_id)
+            session["_fresh"] = True
+
+        for _ in range(requests):
+            url = next(urls)
+            counter.reset()
+            started = time.perf_counter()
+            response = client.get(url)
+            latency = time.perf_counter() - started
+            samples.append(Sample(latency, counter.count, response.status_code))
+
+    workers = [
+        threading.Thread(target=worker, args=(count // threads + (i < count % threads),))
+        for i in range(threads)
+    ]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    return samples, time.perf_counter() - started
+
+
+def summarize(sequential: list[Sample], concurrent: list[Sample], elapsed: float) -> dict:
+    latencies = [sample.latency * 1000 for sample in sequential]
+
+    return {
+        "requests": len(sequential),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "queries_per_request": round(statistics.mean(s.queries for s in sequential), 2),
+        "errors": sum(s.status >= 400 for s in sequential + concurrent),
+        "concurrent_requests": len(concurrent),
+        "throughput_rps": round(len(concurrent) / elapsed, 1) if concurrent else None,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def previous_result(output: Path, current: Path):
+    results = sorted(path for path in output.glob("*.json") if path != current)
+    return json.loads(results[-1].read_text()) if results else None
+
+
+def print_report(result: dict, previous: dict = None):
+    click.echo(
+        f"{'scenario':<20}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}"
+        f"{'queries':>10}{'errors':>8}{'p95 vs prev':>14}"
+    )
+    for name, stats in result["scenarios"].items():
+        change = ""
+        if previous and name in previous["scenarios"] and previous["scenarios"][name]["p95_ms"]:
+            before = previous["scenarios"][name]["p95_ms"]
+            change = f"{(stats['p95_ms'] - before) / before:+.0%}"
+        click.echo(
+            f"{name:<20}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}"
+            f"{stats['throughput_rps'] or '-':>10}{stats['queries_per_request']:>10}"
+            f"{stats['errors']:>8}{change:>14}"
+        )
+
+
+@click.command()
+@click.option(
+    "--requests", default=200, show_default=True, help="Sequential requests per scenario."
+)
+@click.option("--concurrent-requests", default=200, show_default=True)
+@click.option("--threads", default=8, show_default=True)
+@click.option("--warmup", default=10, show_default=True)
+@click.option(
+    "--sample-size", default=200, show_default=True, help="Books and members to visit."
+)
+@click.option("--scenario", "only", multiple=True, help="Run only the given scenarios.")
+@click.option("--output", default=str(RESULTS_DIR), show_default=True, type=click.Path())
+def benchmark(requests, concurrent_requests, threads, warmup, sample_size, only, output):
+    """Benchmark the main views against the database in MONGO_URI, e.g. filled by populate_db.
+
+    Reports latency percentiles of sequential requests, throughput with concurrent threads and
+    MongoDB commands per request, saves them to OUTPUT and compares p95 with the last run.
+    """
+    counter = CommandCounter()
+    # Listeners only apply to clients created afterwards, and library creates its client on import
+    monitoring.register(counter)
+
+    from library import create_app
+    from library.auth.models import User
+    from library.books.models import Book
+    from library.books.models import Rent
+
+    app = create_app()
+    app.config["DEBUG"] = False
+    admin = User.find_one({"is_admin": True}).run()
+    if not admin:
+        raise click.ClickException("No admin found; fill the database with populate_db first")
+
+    total = warmup + requests + concurrent_requests
+    scenarios = [
+        scenario
+        for scenario in build_scenarios(sample_size, total)
+        if not only or scenario.name in only
+    ]
+
+    result = {
+        "revision": git_revision(),
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "dataset": {model.__name__: model.count() for model in [Book, User, Rent]},
+        "settings": {"requests": requests, "threads": threads, "warmup": warmup},
+        "scenarios": {},
+    }
+
+    for scenario in scenarios:
+        click.echo(f"{scenario.name}...", err=True)
+        urls = itertools.islice(itertools.cycle(scenario.urls), total)
+        drive(app, counter, admin.id, urls, warmup, 1)
+        sequential, _ = drive(app, counter, admin.id, urls, requests, 1)
+        concurrent, elapsed = drive(app, counter, admin.id, urls, concurrent_requests, threads)
+        result["scenarios"][scenario.name] = summarize(sequential, concurrent, elapsed)
+
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    path = output / f"{result['created_at'].replace(':', '')}-{result['revision']}.json"
+    path.write_text(json.dumps(result, indent=2))
+
+    print_report(result, previous_result(output, path))
+    click.echo(f"Saved to {path}")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,39 +1,70 @@
 from os import environ
 
-from bunnet import init_bunnet
 from flask import Flask
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
 from pymongo import MongoClient
 
+from library.metrics import command_metrics
+from library.metrics import current_endpoint
+from library.profiling import query_profiler
+from library.profiling import report_queries
 
-mongo_client = MongoClient(environ.get("MONGO_URI", "mongodb://localhost:27017/"))
+
+mongo_client = MongoClient(
+    environ.get("MONGO_URI", "mongodb://localhost:27017/"),
+    event_listeners=[command_metrics, query_profiler],
+)
 bcrypt = Bcrypt()
 login_manager = LoginManager()
 login_manager.login_view = "auth.login"
+# API clients get a 401 instead of a redirect to the login page
+login_manager.blueprint_login_views["api"] = None
 
 
-def create_app():
+def create_app(typeahead: bool = True):
     app = Flask(__name__)
     app.config["DEBUG"] = True
     app.config["SECRET_KEY"] = "!9)m$3d@gnm5hwhy16r(je*l1y1ry)xs!58c77se0_3p9596^4"
+    app.config["QUERY_PROFILING"] = environ.get("QUERY_PROFILING") == "1"
+    app.config["SLOW_QUERY_MS"] = float(environ.get("SLOW_QUERY_MS", 100))
+    command_metrics.bytes_sample_rate = float(environ.get("MONGO_METRICS_BYTES_SAMPLE", 0))
 
     login_manager.init_app(app)
     bcrypt.init_app(app)
 
-    from library.books.models import Book
-    from library.auth.models import User
-    from library.books.models import Rent
-    from library.books.models import Review
+    from library.indexes import check as check_indexes
+    from library.indexes import init_models
+    from library.models import document_models
+    from library.commands import exports
+    from library.commands import indexes
+    from library.books.commands import books_cli
+    from library.books.typeahead import title_typeahead
+
+    init_models(mongo_client["library"], document_models)
+    check_indexes(document_models)
+    # Loaded in the background from startup, so the first suggestions are not empty
+    if typeahead:
+        title_typeahead.start()
+    app.cli.add_command(indexes)
+    app.cli.add_command(exports)
+    app.cli.add_command(books_cli)
+
+    @app.after_request
+    def count_request(response):
+        command_metrics.observe_request(current_endpoint())
+        return response
 
-    init_bunnet(database=mongo_client["library"], document_models=[Book, User, Rent, Review])
+    app.after_request(report_queries)
 
     from library.books.routes import books
     from library.main.routes import main
     from library.auth.routes import auth
+    from library.api.routes import api
 
     app.register_blueprint(books)
     app.register_blueprint(main)
     app.register_blueprint(auth)
+    app.register_blueprint(api)
 
     return app
@@ -0,0 +1,83 @@
+import json
+from typing import NamedTuple
+
+from flask import abort
+from flask import Response
+from pydantic import BaseModel
+
+from library.auth.models import User
+from library.books.models import Book
+from library.books.models import Rent
+from library.books.models import Review
+from library.utils import json_default
+
+encode = json.JSONEncoder(default=json_default, separators=(",", ":")).encode
+
+
+class Resource(NamedTuple):
+    model: type
+    default: tuple[str, ...]
+    hidden: tuple[str, ...] = ()
+
+    @property
+    def selectable(self) -> set[str]:
+        names = set()
+        for field in self.model.__fields__.values():
+            if field.alias in ("_id", "revision_id") or field.alias in self.hidden:
+                continue
+            names.add(field.alias)
+            if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+                names |= {
+                    f"{field.alias}.{sub.alias}" for sub in field.type_.__fields__.values()
+                }
+
+        return names
+
+
+BOOKS = Resource(
+    Book,
+    ("title", "authors", "genre", "publication_date", "isbn", "stock"),
+    hidden=("title_keys",),
+)
+RENTS = Resource(Rent, ("book", "user", "rent_date", "due_date", "return_date"))
+REVIEWS = Resource(Review, ("book_id", "user", "rating", "comment", "created_at"))
+MEMBERS = Resource(
+    User, ("first_name", "last_name", "email", "phone_number"), hidden=("password",)
+)
+
+
+def select_fields(resource: Resource, value: str = None) -> list[str]:
+    if not value:
+        return list(resource.default)
+
+    fields = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = set(fields) - resource.selectable
+    if unknown:
+        abort(400, f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    # Mongo rejects a projection holding both a field and one of its subfields
+    parents = {name for name in fields if "." not in name}
+    return [
+        name
+        for name in dict.fromkeys(fields)
+        if "." not in name or name.split(".")[0] not in parents
+    ]
+
+
+def projection(fields: list[str]) -> dict:
+    return {name: 1 for name in fields}
+
+
+def serialize(document: dict, fields: list[str]) -> dict:
+    # Stored dates are already the strings datetime_encoders produce, so the raw document
+    # only needs its id renamed and any extra keys (e.g. cursor sort keys) dropped.
+    item = {"id": document["_id"]}
+    for name in dict.fromkeys(name.split(".")[0] for name in fields):
+        if name in document:
+            item[name] = document[name]
+
+    return item
+
+
+def json_response(payload, status: int = 200) -> Response:
+    return Response(encode(payload), status=status, mimetype="application/json")
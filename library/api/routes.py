@@ -0,0 +1,183 @@
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import abort
+from flask import Blueprint
+from flask import request
+from flask_login import current_user
+from flask_login import login_required
+from flask_login import login_user
+from flask_login import logout_user
+from werkzeug.exceptions import HTTPException
+
+from library import bcrypt
+from library.api.fields import BOOKS
+from library.api.fields import json_response
+from library.api.fields import MEMBERS
+from library.api.fields import projection
+from library.api.fields import RENTS
+from library.api.fields import REVIEWS
+from library.api.fields import select_fields
+from library.api.fields import serialize
+from library.auth.decorators import admin_role_required
+from library.auth.models import User
+from library.auth.models import user_cache
+from library.books.models import Book
+from library.books.models import OPEN_RENT
+from library.books.models import Rent
+from library.books.models import Review
+from library.pagination import paginate
+from library.profiling import query_budget
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+
+@api.errorhandler(HTTPException)
+def http_error(error):
+    return json_response({"error": error.name, "message": error.description}, error.code)
+
+
+def _object_id(value: str, code: int = 404) -> ObjectId:
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise abort(code)
+
+
+def _page(query, resource):
+    fields = select_fields(resource, request.args.get("fields"))
+    page_size = min(max(request.args.get("page_size", PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+
+    documents, pagination = paginate(
+        query,
+        page_size,
+        page=request.args.get("page", None, type=int),
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+        projection=projection(fields),
+    )
+
+    return json_response(
+        {
+            "data": [serialize(document, fields) for document in documents],
+            "pagination": pagination,
+        }
+    )
+
+
+def _one(resource, document_id: str):
+    fields = select_fields(resource, request.args.get("fields"))
+    document = resource.model.get_motor_collection().find_one(
+        {"_id": _object_id(document_id)}, projection(fields)
+    )
+    if not document:
+        abort(404)
+
+    return json_response({"data": serialize(document, fields)})
+
+
+@api.route("/session", methods=["POST"])
+def login():
+    credentials = request.get_json(silent=True) or {}
+    user = User.find_one(User.email == str(credentials.get("email", ""))).run()
+    if not user or not bcrypt.check_password_hash(
+        user.password, str(credentials.get("password", ""))
+    ):
+        abort(401, "Invalid email or password")
+
+    login_user(user)
+    return json_response({"data": {"id": user.id, "is_admin": user.is_admin}})
+
+
+@api.route("/session", methods=["DELETE"])
+def logout():
+    if current_user.is_authenticated:
+        user_cache.invalidate(str(current_user.id))
+    logout_user()
+    return "", 204
+
+
+@api.route("/books", methods=["GET"])
+@query_budget(4)
+@login_required
+def list_books():
+    query = Book.filter(
+        title=request.args.get("title", None),
+        genre=request.args.get("genre", None),
+        author=request.args.get("author", None),
+        available=request.args.get("available", None, type=bool),
+        isbn=request.args.get("isbn", None),
+        order_by=request.args.get("order_by", None),
+    )
+
+    return _page(query, BOOKS)
+
+
+@api.route("/books/<book_id>", methods=["GET"])
+@query_budget(2)
+@login_required
+def get_book(book_id):
+    return _one(BOOKS, book_id)
+
+
+@api.route("/books/<book_id>/reviews", methods=["GET"])
+@query_budget(3)
+@login_required
+def list_reviews(book_id):
+    query = Review.find(Review.book_id == _object_id(book_id)).sort(-Review.created_at)
+
+    return _page(query, REVIEWS)
+
+
+@api.route("/rents", methods=["GET"])
+@query_budget(3)
+@login_required
+def list_rents():
+    # Members only ever see their own rents
+    user_id = request.args.get("user_id") if current_user.is_admin else str(current_user.id)
+    book_id = request.args.get("book_id")
+    status = request.args.get("status")
+
+    query = Rent.find()
+    if user_id:
+        query = query.find(Rent.user.id == _object_id(user_id, 400))
+    if book_id:
+        query = query.find(Rent.book.id == _object_id(book_id, 400))
+    if status == "open":
+        query = query.find(OPEN_RENT)
+    elif status == "returned":
+        query = query.find({"return_date": {"$ne": None}})
+    elif status:
+        abort(400, "status must be open or returned")
+
+    # Same order as the member's rent history, so it is served by the user.$id indexes
+    query = query.sort(-Rent.rent_date, -Rent.id) if user_id else query.sort(-Rent.id)
+
+    return _page(query, RENTS)
+
+
+@api.route("/members", methods=["GET"])
+@query_budget(3)
+@login_required
+@admin_role_required
+def list_members():
+    query = User.filter(
+        first_name=request.args.get("first_name", None),
+        last_name=request.args.get("last_name", None),
+        email=request.args.get("email", None),
+        phone_number=request.args.get("phone_number", None),
+    )
+
+    return _page(query, MEMBERS)
+
+
+@api.route("/members/<user_id>", methods=["GET"])
+@query_budget(2)
+@login_required
+def get_member(user_id):
+    if not current_user.is_admin and str(current_user.id) != user_id:
+        abort(403)
+
+    return _one(MEMBERS, user_id)
@@ -1,9 +1,14 @@
 import datetime
 from typing import Optional
 
+from bunnet import after_event
+from bunnet import Delete
 from bunnet import Document
 from bunnet import Indexed
 from bunnet import PydanticObjectId
+from bunnet import Replace
+from bunnet import SaveChanges
+from bunnet import Update
 from bunnet.odm.operators.find.evaluation import RegEx
 from flask import url_for
 from flask_login import UserMixin
@@ -11,12 +16,24 @@ from pydantic import BaseModel
 from pydantic import Field
 
 from library import login_manager
+from library.cache import TTLCache
 from library.utils import datetime_encoders
 
 
+# Each worker process keeps its own copy, so the TTL bounds how long a change made
+# through another process (e.g. revoking is_admin) can go unnoticed.
+user_cache = TTLCache(maxsize=4096, ttl=60)
+
+
 @login_manager.user_loader
 def load_user(user_id: str):
-    return User.get(PydanticObjectId(user_id)).run()
+    user = user_cache.get(user_id)
+    if user is None:
+        user = User.get(PydanticObjectId(user_id)).run()
+        if user:
+            user_cache.set(user_id, user)
+
+    return user
 
 
 class Address(BaseModel):
@@ -43,6 +60,10 @@ class User(UserMixin, Document):
     class Settings:
         bson_encoders = {**datetime_encoders}
 
+    @after_event(Replace, SaveChanges, Update, Delete)
+    def invalidate_cache(self):
+        user_cache.invalidate(str(self.id))
+
     @classmethod
     def filter(
         cls,
@@ -82,3 +103,15 @@ class User(UserMixin, Document):
     @property
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
+
+
+class MemberRow(BaseModel):
+    id: PydanticObjectId = Field(alias="_id")
+    first_name: str
+    last_name: str
+    email: str
+    phone_number: str
+
+    @property
+    def details_url(self):
+        return url_for("auth.user_details", user_id=self.id)
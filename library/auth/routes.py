@@ -1,6 +1,5 @@
-import math
+from urllib.parse import urlencode
 
-from bunnet import PydanticObjectId
 from flask import abort
 from flask import Blueprint
 from flask import flash
@@ -19,8 +18,13 @@ from library.auth.forms import LoginForm
 from library.auth.forms import RegisterForm
 from library.auth.forms import SearchUserForm
 from library.auth.models import Address
+from library.auth.models import MemberRow
 from library.auth.models import User
+from library.auth.models import user_cache
+from library.books.forms import BatchRentForm
 from library.books.models import Rent
+from library.pagination import paginate
+from library.profiling import query_budget
 
 auth = Blueprint("auth", __name__)
 
@@ -45,6 +49,8 @@ def login():
 
 @auth.route("/logout")
 def logout():
+    if current_user.is_authenticated:
+        user_cache.invalidate(str(current_user.id))
     logout_user()
     return redirect(url_for("main.home"))
 
@@ -78,10 +84,11 @@ def register():
 
 
 @auth.route("/members", methods=["GET"])
+@query_budget(3)
 @login_required
 @admin_role_required
 def member_list():
-    page = request.args.get("page", 1, type=int)
+    page = request.args.get("page", None, type=int)
     page_size = request.args.get("page_size", 24, type=int)
 
     filters = {
@@ -94,16 +101,14 @@ def member_list():
     form = SearchUserForm(**filters)
     filters_query_string = "&".join([f"{k}={v}" for k, v in filters.items() if v])
 
-    query = User.filter(**filters)
-    users = query.skip((page - 1) * page_size).limit(page_size).run()
-    total = query.count()
-
-    pagination = {
-        "page": page,
-        "page_size": page_size,
-        "total": total,
-        "total_pages": math.ceil(total / page_size),
-    }
+    query = User.filter(**filters).project(MemberRow)
+    users, pagination = paginate(
+        query,
+        page_size,
+        page=page,
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
 
     return render_template(
         "auth/member_list.html",
@@ -115,27 +120,45 @@ def member_list():
 
 
 @auth.route("/members/<user_id>", methods=["GET"])
+@query_budget(6)
 @login_required
 def user_details(user_id):
     user = User.get(user_id).run()
 
+    if not user:
+        abort(404)
+
     if not current_user.is_admin and current_user.id != user.id:
         abort(403)
 
-    if not user:
-        abort(404)
+    # Both lists page independently, so each keeps its own prefixed query parameters
+    history = {}
+    for prefix, returned in (("open_", False), ("returned_", True)):
+        history[prefix] = paginate(
+            Rent.get_history(user.id, returned=returned),
+            request.args.get(f"{prefix}page_size", 10, type=int),
+            page=request.args.get(f"{prefix}page", None, type=int),
+            after=request.args.get(f"{prefix}after"),
+            before=request.args.get(f"{prefix}before"),
+        )
 
-    rents = (
-        Rent.find(Rent.user.id == PydanticObjectId(user_id), fetch_links=True)
-        .sort(-Rent.rent_date)
-        .run()
-    )
-    already_returned = [rent for rent in rents if rent.return_date]
-    not_returned = [rent for rent in rents if not rent.return_date]
+    not_returned, open_pagination = history["open_"]
+    already_returned, returned_pagination = history["returned_"]
 
     return render_template(
         "auth/user_details.html",
         user=user,
         already_returned=already_returned,
         not_returned=not_returned,
+        batch_rent_form=BatchRentForm(),
+        open_pagination=open_pagination,
+        returned_pagination=returned_pagination,
+        open_query_string=_prefixed_query_string("open_"),
+        returned_query_string=_prefixed_query_string("returned_"),
+    )
+
+
+def _prefixed_query_string(prefix: str) -> str:
+    return urlencode(
+        {key: value for key, value in request.args.items() if key.startswith(prefix)}
     )
@@ -0,0 +1,220 @@
+import datetime
+import re
+
+import click
+from flask.cli import AppGroup
+from pymongo import UpdateOne
+
+from library.books.imports import BATCH_SIZE
+from library.books.imports import detect_format
+from library.books.imports import FORMATS
+from library.books.imports import import_books
+from library.books.imports import read_rows
+from library.books.models import Author
+from library.books.models import Book
+from library.books.models import BookRecommendations
+from library.books.models import CirculationStats
+from library.books.models import OverdueRent
+from library.books.models import Review
+from library.books.search import normalize_isbn
+from library.books.search import title_words
+
+# Anything else (dashes, spaces, a lower-case check digit) is rewritten by normalize-isbns
+NORMALIZED_ISBN = re.compile(r"^[0-9X]*$")
+
+books_cli = AppGroup("books", help="Catalogue maintenance commands.")
+
+
+def rating_aggregates(book_ids: list) -> dict:
+    pipeline = [
+        {"$match": {"book_id": {"$in": book_ids}}},
+        {
+            "$group": {
+                "_id": "$book_id",
+                "review_count": {"$sum": 1},
+                "rating_sum": {"$sum": "$rating"},
+                **{
+                    str(star): {"$sum": {"$cond": [{"$eq": ["$rating", star]}, 1, 0]}}
+                    for star in range(1, 6)
+                },
+            }
+        },
+    ]
+
+    aggregates = {}
+    for group in Review.get_motor_collection().aggregate(pipeline):
+        aggregates[group["_id"]] = {
+            "review_count": group["review_count"],
+            "rating_sum": group["rating_sum"],
+            "rating_histogram": {
+                str(star): group[str(star)] for star in range(1, 6) if group[str(star)]
+            },
+        }
+
+    return aggregates
+
+
+def update_ratings(book_ids: list):
+    empty = {"review_count": 0, "rating_sum": 0, "rating_histogram": {}}
+    aggregates = rating_aggregates(book_ids)
+    # Cached pages and fragments are keyed by updated_at, so corrected counters must move it
+    updated_at = datetime.datetime.now().isoformat()
+
+    Book.get_motor_collection().bulk_write(
+        [
+            UpdateOne(
+                {"_id": book_id},
+                {
+                    "$set": {**aggregates.get(book_id, empty), "updated_at": updated_at},
+                    "$unset": {"avg_rating": ""},
+                },
+            )
+            for book_id in book_ids
+        ],
+        ordered=False,
+    )
+
+
+@books_cli.command("recompute-ratings")
+@click.option("--batch-size", default=1000, show_default=True)
+def recompute_ratings(batch_size):
+    """Rebuild review counts, rating sums and histograms from the Review collection."""
+    collection = Book.get_motor_collection()
+    last_id = None
+    updated = 0
+
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        book_ids = [
+            book["_id"]
+            for book in collection.find(query, {"_id": 1}).sort("_id").limit(batch_size)
+        ]
+        if not book_ids:
+            break
+
+        update_ratings(book_ids)
+
+        updated += len(book_ids)
+        last_id = book_ids[-1]
+        click.echo(f"{updated} books updated")
+
+
+@books_cli.command("normalize-isbns")
+@click.option("--batch-size", default=1000, show_default=True)
+def normalize_isbns(batch_size):
+    """Strip dashes and spaces from stored ISBNs, which searches compare exactly."""
+    collection = Book.get_motor_collection()
+    last_id = None
+    updated = 0
+
+    while True:
+        query = {"isbn": {"$not": NORMALIZED_ISBN}}
+        if last_id:
+            query["_id"] = {"$gt": last_id}
+        books = list(collection.find(query, {"isbn": 1}).sort("_id").limit(batch_size))
+        if not books:
+            break
+
+        updated_at = datetime.datetime.now().isoformat()
+        collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": book["_id"]},
+                    {"$set": {"isbn": normalize_isbn(book["isbn"]), "updated_at": updated_at}},
+                )
+                for book in books
+            ],
+            ordered=False,
+        )
+
+        updated += len(books)
+        last_id = books[-1]["_id"]
+        click.echo(f"{updated} books updated")
+
+
+@books_cli.command("rebuild-title-keys")
+@click.option("--batch-size", default=1000, show_default=True)
+def rebuild_title_keys(batch_size):
+    """Recompute the title word keys that title searches look prefixes up in."""
+    collection = Book.get_motor_collection()
+    last_id = None
+    updated = 0
+
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        books = list(collection.find(query, {"title": 1}).sort("_id").limit(batch_size))
+        if not books:
+            break
+
+        collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": book["_id"]}, {"$set": {"title_keys": title_words(book["title"])}}
+                )
+                for book in books
+            ],
+            ordered=False,
+        )
+
+        updated += len(books)
+        last_id = books[-1]["_id"]
+        click.echo(f"{updated} books updated")
+
+
+@books_cli.command("sweep-overdue")
+def sweep_overdue():
+    """Rebuild the overdue rents list; meant to run once a day, e.g. from cron."""
+    click.echo(f"{OverdueRent.sweep()} overdue rents")
+
+
+@books_cli.command("backfill-stats")
+@click.option(
+    "--since",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    help="First day to rebuild, defaults to the whole history.",
+)
+def backfill_stats(since):
+    """Rebuild the daily circulation rollups from rent history, best while the desk is closed."""
+    since = since.date() if since else None
+    click.echo(f"{CirculationStats.backfill(since)} rollup documents")
+
+
+@books_cli.command("refresh-recommendations")
+@click.option("--full", is_flag=True, help="Rebuild from the whole rent history.")
+def refresh_recommendations(full):
+    """Add the rents made since the last run to the co-borrowing counts and re-rank their books."""
+    run = BookRecommendations.refresh(full=full)
+    click.echo(f"{run.rents} rents counted, {run.books} books re-ranked")
+
+
+@books_cli.command("rebuild-authors")
+def rebuild_authors():
+    """Rebuild the author directory from the authors listed on every book."""
+    click.echo(f"{Author.rebuild()} authors")
+
+
+@books_cli.command("import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format", "file_format", type=click.Choice(FORMATS), help="Defaults to the extension."
+)
+@click.option("--batch-size", default=BATCH_SIZE, show_default=True)
+def import_catalogue(path, file_format, batch_size):
+    """Upsert books by ISBN from a CSV or JSON Lines file, streaming it in batches."""
+    file_format = file_format or detect_format(path)
+    if file_format not in FORMATS:
+        raise click.BadParameter(f"Unknown format {file_format!r}, use --format")
+
+    with open(path, newline="", encoding="utf-8-sig") as stream:
+        report = import_books(
+            read_rows(stream, file_format),
+            batch_size=batch_size,
+            progress=lambda rows: click.echo(f"{rows} rows processed"),
+        )
+
+    for error in report.errors:
+        click.echo(f"line {error.line} ({error.isbn or 'no ISBN'}): {error.message}", err=True)
+    click.echo(
+        f"{report.rows} rows: {report.inserted} added, {report.updated} updated, "
+        f"{report.failed} failed"
+    )
@@ -1,6 +1,9 @@
 from datetime import datetime
 
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileAllowed
+from flask_wtf.file import FileField
+from flask_wtf.file import FileRequired
 from wtforms import BooleanField
 from wtforms import DateField
 from wtforms import IntegerField
@@ -8,6 +11,7 @@ from wtforms import SearchField
 from wtforms import SelectField
 from wtforms import StringField
 from wtforms import SubmitField
+from wtforms import TextAreaField
 from wtforms.validators import DataRequired
 from wtforms.validators import Length
 from wtforms.validators import ValidationError
@@ -21,15 +25,26 @@ GENRE_CHOICES = [("", "Select a genre")] + [(x.value, x.value) for x in BookGenr
 
 
 class FilterBooksForm(FlaskForm):
-    title = SearchField("Title")
+    title = SearchField("Title", render_kw={"list": "title-suggestions", "autocomplete": "off"})
     genre = SelectField("Genre", choices=GENRE_CHOICES, default="")  # type: ignore
-    author = SearchField("Author")
+    author = SearchField(
+        "Author", render_kw={"list": "author-suggestions", "autocomplete": "off"}
+    )
     isbn = SearchField("ISBN")
     available = BooleanField("Only available", default=False)
     order_by = SelectField("Order by", choices=ORDER_CHOICES, default="none")
 
     submit = SubmitField("Filter")
 
+    def show_counts(self, facets):
+        # Counts describe the current results, so with a genre chosen the others would be 0
+        if not self.genre.data:
+            self.genre.choices = GENRE_CHOICES[:1] + [
+                (value, f"{label} ({facets.genres.get(value, 0)})")
+                for value, label in GENRE_CHOICES[1:]
+            ]
+        self.available.label.text = f"{self.available.label.text} ({facets.available})"
+
 
 class RentBookForm(FlaskForm):
     email_or_phone_number = SearchField("Email or phone number", validators=[DataRequired()])
@@ -77,6 +92,26 @@ class AddBookForm(FlaskForm):
     submit = SubmitField("Add")
 
 
+class BatchRentForm(FlaskForm):
+    books = TextAreaField(
+        "Book ids or ISBNs, one per line", validators=[DataRequired(), Length(max=5000)]
+    )
+    checkout = SubmitField("Rent all")
+    checkin = SubmitField("Return all")
+
+    @property
+    def identifiers(self) -> list[str]:
+        return list(dict.fromkeys(self.books.data.split()))
+
+
+class ImportBooksForm(FlaskForm):
+    file = FileField(
+        "CSV or JSON Lines file",
+        validators=[FileRequired(), FileAllowed(["csv", "jsonl", "ndjson", "json"])],
+    )
+    submit = SubmitField("Import")
+
+
 class AddReviewForm(FlaskForm):
     rating = SelectField(
         "Rating", validators=[DataRequired()], choices=[(x, x) for x in range(1, 6)]
@@ -0,0 +1,219 @@
+import csv
+import json
+from typing import NamedTuple
+
+from bunnet.odm.utils.dump import get_dict
+from pydantic import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from library.books.models import Author
+from library.books.models import Book
+from library.books.models import facet_cache
+from library.books.search import is_isbn
+from library.books.search import normalize_isbn
+
+BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+FORMATS = ("csv", "jsonl")
+# In CSV files the list columns hold values separated by semicolons
+LIST_FIELDS = ("authors", "images_urls")
+LIST_SEPARATOR = ";"
+# Owned by reviews and rents, so an import only fills them in for new books
+COUNTERS = {"review_count": 0, "rating_sum": 0, "rating_histogram": {}}
+# Optional in the file; when left out, existing books keep theirs and new ones get these
+INSERT_DEFAULTS = {"images_urls": []}
+
+
+class RowError(NamedTuple):
+    line: int
+    isbn: str
+    message: str
+
+
+class ImportReport(NamedTuple):
+    rows: int
+    inserted: int
+    updated: int
+    failed: int
+    errors: list[RowError]
+
+
+def detect_format(filename: str) -> str:
+    extension = filename.rsplit(".", 1)[-1].lower()
+    if extension in ("json", "ndjson"):
+        return "jsonl"
+    return extension
+
+
+def read_rows(stream, file_format: str):
+    if file_format == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            values = {
+                key: value for key, value in row.items() if key and value not in ("", None)
+            }
+            for field in LIST_FIELDS:
+                if field in values:
+                    values[field] = [
+                        item.strip()
+                        for item in values[field].split(LIST_SEPARATOR)
+                        if item.strip()
+                    ]
+            yield reader.line_num, values, None
+    else:
+        for line, text in enumerate(stream, 1):
+            if not text.strip():
+                continue
+            try:
+                yield line, json.loads(text), None
+            except ValueError as error:
+                yield line, None, f"invalid JSON: {error}"
+
+
+def _validation_message(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in detail['loc'])}: {detail['msg']}"
+        for detail in error.errors()
+    )
+
+
+def to_document(row: dict) -> dict:
+    if not isinstance(row, dict):
+        raise ValueError("expected an object")
+
+    isbn = normalize_isbn(str(row.get("isbn", "")))
+    if not is_isbn(isbn):
+        raise ValueError(f"isbn: {row.get('isbn')!r} is not a valid ISBN")
+
+    missing = INSERT_DEFAULTS.keys() - row.keys()
+    row = {**INSERT_DEFAULTS, **row, "isbn": isbn}
+    row.setdefault("initial_stock", row.get("stock"))
+    row.setdefault("stock", row["initial_stock"])
+
+    document = get_dict(Book.parse_obj(row), to_db=True)
+    for field in missing:
+        document.pop(field)
+
+    return document
+
+
+def upsert(document: dict) -> UpdateOne:
+    initial_stock = document.pop("initial_stock")
+    created_at = document.pop("created_at")
+    document.pop("stock")
+    for counter in COUNTERS:
+        document.pop(counter)
+
+    # Copies that are lent out stay lent out, so a changed initial_stock moves stock by
+    # the difference. Values go through $literal, as a title like "$5 Dinners" would
+    # otherwise be read as a field path.
+    stock = {
+        "$add": [
+            {"$ifNull": ["$stock", 0]},
+            {"$subtract": [initial_stock, {"$ifNull": ["$initial_stock", 0]}]},
+        ]
+    }
+    changes = {
+        **{field: {"$literal": value} for field, value in document.items()},
+        "stock": {"$max": [stock, 0]},
+        "initial_stock": initial_stock,
+        "created_at": {"$ifNull": ["$created_at", created_at]},
+        **{
+            field: {"$ifNull": [f"${field}", {"$literal": value}]}
+            for field, value in COUNTERS.items()
+        },
+        **{
+            field: {"$ifNull": [f"${field}", {"$literal": value}]}
+            for field, value in INSERT_DEFAULTS.items()
+            if field not in document
+        },
+    }
+
+    return UpdateOne({"isbn": document["isbn"]}, [{"$set": changes}], upsert=True)
+
+
+def _author_changes(batch: list, existing: dict, upserted: dict, failed: set) -> list:
+    changes = []
+    for index, (*_, isbn, authors, _) in enumerate(batch):
+        if index in failed:
+            continue
+        if isbn in existing:
+            changes.append((existing[isbn]["_id"], existing[isbn]["authors"], authors))
+        elif index in upserted:
+            changes.append((upserted[index], [], authors))
+
+    return changes
+
+
+def import_books(rows, batch_size: int = BATCH_SIZE, progress=None) -> ImportReport:
+    collection = Book.get_motor_collection()
+    total = inserted = updated = failed = 0
+    errors = []
+    batch = []
+
+    def fail(line, row, message):
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            isbn = row.get("isbn", "") if isinstance(row, dict) else ""
+            errors.append(RowError(line, str(isbn), message))
+
+    def flush():
+        nonlocal inserted, updated
+        # The authors the books had before the import, for keeping the Author index in sync
+        existing = {
+            book["isbn"]: book
+            for book in collection.find(
+                {"isbn": {"$in": [isbn for *_, isbn, _, _ in batch]}}, {"isbn": 1, "authors": 1}
+            )
+        }
+        failed_rows = set()
+        try:
+            result = collection.bulk_write(
+                [operation for *_, operation in batch], ordered=False
+            )
+            inserted += result.upserted_count
+            updated += result.matched_count
+            upserted = result.upserted_ids
+        except BulkWriteError as error:
+            inserted += error.details["nUpserted"]
+            updated += error.details["nMatched"]
+            upserted = {entry["index"]: entry["_id"] for entry in error.details["upserted"]}
+            for write_error in error.details["writeErrors"]:
+                line, row, *_ = batch[write_error["index"]]
+                failed_rows.add(write_error["index"])
+                fail(line, row, write_error["errmsg"])
+        Author.sync(_author_changes(batch, existing, upserted, failed_rows))
+        batch.clear()
+        if progress:
+            progress(total)
+
+    for line, row, error in rows:
+        total += 1
+        if error:
+            fail(line, row, error)
+            continue
+
+        try:
+            document = to_document(row)
+            isbn, authors = document["isbn"], document["authors"]
+            operation = upsert(document)
+        except ValidationError as error:
+            fail(line, row, _validation_message(error))
+            continue
+        except ValueError as error:
+            fail(line, row, str(error))
+            continue
+
+        batch.append((line, row, isbn, authors, operation))
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+    # Only this process's cache; other workers' entries run out with its TTL
+    if inserted or updated:
+        facet_cache.clear()
+
+    return ImportReport(total, inserted, updated, failed, errors)
@@ -1,22 +1,58 @@
 import datetime
+from collections import Counter
+from collections import defaultdict
 from decimal import Decimal
 from enum import Enum
+from typing import NamedTuple
 from typing import Optional
 
+from bson import ObjectId
+from bunnet import before_event
 from bunnet import Document
 from bunnet import Indexed
+from bunnet import Insert
 from bunnet import Link
 from bunnet import PydanticObjectId
-from bunnet.odm.operators.find.array import ElemMatch
-from bunnet.odm.operators.find.evaluation import RegEx
+from bunnet import Replace
+from bunnet.odm.enums import SortDirection
+from bunnet.odm.operators.find.comparison import In
+from bunnet.odm.operators.update.general import Inc
+from bunnet.odm.operators.update.general import Set
+from bunnet.odm.utils.parsing import parse_obj
 from flask import url_for
+from pydantic import BaseModel
 from pydantic import Field
+from pydantic import validator
+from pymongo import ASCENDING
+from pymongo import DESCENDING
+from pymongo import IndexModel
+from pymongo import UpdateOne
 
 from library.auth.models import User
+from library.books.search import author_keys
+from library.books.search import is_isbn
+from library.books.search import normalize_author
+from library.books.search import normalize_isbn
+from library.books.search import prefix
+from library.books.search import text_index
+from library.books.search import TEXT_SCORE
+from library.books.search import text_search
+from library.books.search import title_words
+from library.books.search import whole_words
+from library.books.search import word_prefix
+from library.cache import TTLCache
+from library.transactions import after_commit
 from library.utils import datetime_encoders
 from library.utils import next_month_factory
 
 
+AUTOCOMPLETE_LIMIT = 10
+# A short prefix can match many authors; the book filter takes at most AUTHOR_BOOK_MATCHES
+# books of the first AUTHOR_MATCHES of them
+AUTHOR_MATCHES = 100
+AUTHOR_BOOK_MATCHES = 1000
+
+
 class BookOrders(str, Enum):
     NONE = "None"
     TITLE_ASC = "Title Ascending"
@@ -69,6 +105,8 @@ class BookGenre(str, Enum):
 
 class Book(Document):
     title: Indexed(str)
+    # The words of the title, see title_words; filled in from the title, never set directly
+    title_keys: list[str] = Field(default_factory=list)
     authors: list[str]
     topic: str
     genre: Indexed(str)  # BookGenre
@@ -80,13 +118,31 @@ class Book(Document):
     stock: int
     initial_stock: int
     review_count: int = 0
-    avg_rating: Decimal = Decimal(0)
+    rating_sum: int = 0
+    rating_histogram: dict[str, int] = Field(default_factory=dict)
     images_urls: list[str]
     created_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
     updated_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
 
     class Settings:
         bson_encoders = {**datetime_encoders}
+        indexes = [
+            IndexModel([("title", ASCENDING), ("_id", ASCENDING)]),
+            IndexModel([("title_keys", ASCENDING)]),
+            IndexModel([("pages", ASCENDING), ("_id", ASCENDING)]),
+            IndexModel([("publication_date", ASCENDING), ("_id", ASCENDING)]),
+            text_index,
+        ]
+
+    # The validator covers books built from data (forms, imports, populate_db); the event
+    # covers a title changed on a loaded book before it is saved
+    @validator("title_keys", always=True)
+    def _title_keys(cls, value, values):
+        return title_words(values["title"]) if "title" in values else value
+
+    @before_event(Insert, Replace)
+    def update_title_keys(self):
+        self.title_keys = title_words(self.title)
 
     @property
     def detail_url(self):
@@ -106,6 +162,31 @@ class Book(Document):
     def is_available(self):
         return self.stock > 0
 
+    @property
+    def avg_rating(self):
+        if not self.review_count:
+            return Decimal(0)
+
+        return round(Decimal(self.rating_sum) / self.review_count, 2)
+
+    @classmethod
+    def order_keys(cls, order_by: str) -> list[tuple[str, SortDirection]]:
+        order = {
+            BookOrders.TITLE_ASC: (cls.title, SortDirection.ASCENDING),
+            BookOrders.TITLE_DSC: (cls.title, SortDirection.DESCENDING),
+            BookOrders.PAGES_ASC: (cls.pages, SortDirection.ASCENDING),
+            BookOrders.PAGES_DSC: (cls.pages, SortDirection.DESCENDING),
+            BookOrders.PUB_DATE_ASC: (cls.publication_date, SortDirection.ASCENDING),
+            BookOrders.PUB_DATE_DSC: (cls.publication_date, SortDirection.DESCENDING),
+        }.get(order_by)
+
+        if not order:
+            return []
+
+        key, direction = order
+        # _id breaks ties, so the order is total and pages can be addressed by cursor
+        return [(str(key), direction), ("_id", direction)]
+
     @classmethod
     def filter(
         cls,
@@ -118,9 +199,31 @@ class Book(Document):
     ):
         query = cls.find()
 
+        if title and is_isbn(title):
+            isbn, title = title, None
+
+        if isbn:
+            query = query.find(
+                cls.isbn == normalize_isbn(isbn),
+            )
+
+        text_terms = []
         if title:
+            # Complete words go to the text index, which ranks the results. Partial and stop
+            # words cannot be found there, so the longest word of the query is looked up as
+            # a prefix of the title word keys, and the regex then checks the whole phrase.
+            text_terms = whole_words(title)
+            if text_terms:
+                query = query.find(
+                    text_search(*text_terms),
+                )
+            words = title_words(title)
+            if words:
+                query = query.find(
+                    prefix(cls.title_keys, max(words, key=len)),
+                )
             query = query.find(
-                RegEx(cls.title, f".*{title}.*", "i"),
+                word_prefix(cls.title, title),
             )
 
         if genre:
@@ -129,8 +232,8 @@ class Book(Document):
             )
 
         if author:
-            query.find(
-                ElemMatch(cls.authors, {"$regex": author, "$options": "i"}),
+            query = query.find(
+                In(cls.id, Author.find_book_ids(author)),
             )
 
         if available:
@@ -138,32 +241,423 @@ class Book(Document):
                 cls.stock > 0,
             )
 
-        if isbn:
-            query.find(
-                RegEx(cls.title, f".*{title}.*", "i"),
-            )
-
         if order_by and order_by != BookOrders.NONE:
-            if order_by == BookOrders.TITLE_ASC:
-                query = query.sort(cls.title)
-            elif order_by == BookOrders.TITLE_DSC:
-                query = query.sort(-cls.title)
-            elif order_by == BookOrders.PAGES_ASC:
-                query = query.sort(cls.pages)
-            elif order_by == BookOrders.PAGES_DSC:
-                query = query.sort(-cls.pages)
-            elif order_by == BookOrders.PUB_DATE_ASC:
-                query = query.sort(cls.publication_date)
-            elif order_by == BookOrders.PUB_DATE_DSC:
-                query = query.sort(-cls.publication_date)
+            query = query.sort(cls.order_keys(order_by))
+        elif text_terms:
+            query = query.sort(TEXT_SCORE)
 
         return query
 
-    def add_review(self, rating: int):
-        self.avg_rating = (self.avg_rating * self.review_count + rating) / (
-            self.review_count + 1
+    @classmethod
+    def get_details(cls, book_id: str, user_id: str, page: int = 1, page_size: int = 10):
+        book_id = PydanticObjectId(book_id)
+        user_id = PydanticObjectId(user_id)
+
+        pipeline = [
+            {"$match": {"_id": book_id}},
+            {
+                "$lookup": {
+                    "from": Review.get_motor_collection().name,
+                    "pipeline": [
+                        {"$match": {"book_id": book_id}},
+                        {"$sort": {"created_at": -1}},
+                        {"$skip": (page - 1) * page_size},
+                        {"$limit": page_size},
+                        {
+                            "$lookup": {
+                                "from": User.get_motor_collection().name,
+                                "localField": "user.$id",
+                                "foreignField": "_id",
+                                "as": "user",
+                            }
+                        },
+                        {"$unwind": "$user"},
+                        {
+                            "$project": {
+                                "rating": 1,
+                                "comment": 1,
+                                "created_at": 1,
+                                "user.first_name": 1,
+                                "user.last_name": 1,
+                            }
+                        },
+                    ],
+                    "as": "reviews",
+                }
+            },
+            {
+                "$lookup": {
+                    "from": Rent.get_motor_collection().name,
+                    "pipeline": [
+                        {"$match": {"book.$id": book_id, "user.$id": user_id}},
+                        {"$limit": 1},
+                        {"$project": {"_id": 1}},
+                    ],
+                    "as": "user_rents",
+                }
+            },
+            {
+                "$lookup": {
+                    "from": Review.get_motor_collection().name,
+                    "pipeline": [
+                        {"$match": {"book_id": book_id, "user.$id": user_id}},
+                        {"$limit": 1},
+                        {"$project": {"_id": 1}},
+                    ],
+                    "as": "user_reviews",
+                }
+            },
+            {
+                "$lookup": {
+                    "from": BookRecommendations.get_motor_collection().name,
+                    "localField": "_id",
+                    "foreignField": "_id",
+                    "pipeline": [{"$project": {"similar": 1}}],
+                    "as": "recommendations",
+                }
+            },
+        ]
+
+        result = cls.get_motor_collection().aggregate(pipeline)
+        document = next(result, None)
+        if not document:
+            return None
+
+        recommendations = document.pop("recommendations")
+
+        return BookDetails(
+            reviews=document.pop("reviews"),
+            already_rented=bool(document.pop("user_rents")),
+            review_added=bool(document.pop("user_reviews")),
+            similar=recommendations[0].get("similar", []) if recommendations else [],
+            book=parse_obj(cls, document),
         )
-        self.review_count += 1
+
+    @classmethod
+    def get_last_modified(cls, book_id: str) -> Optional[datetime.datetime]:
+        # Everything on the detail page that is not the member's own data moves updated_at
+        # (edits, rents, returns, reviews), except the recommendations refreshed in batches.
+        pipeline = [
+            {"$match": {"_id": PydanticObjectId(book_id)}},
+            {"$project": {"updated_at": 1}},
+            {
+                "$lookup": {
+                    "from": BookRecommendations.get_motor_collection().name,
+                    "localField": "_id",
+                    "foreignField": "_id",
+                    "pipeline": [{"$project": {"refreshed_at": 1}}],
+                    "as": "recommendations",
+                }
+            },
+        ]
+
+        document = next(cls.get_motor_collection().aggregate(pipeline), None)
+        if not document:
+            return None
+
+        stamps = [document["updated_at"]]
+        stamps += [
+            row["refreshed_at"]
+            for row in document["recommendations"]
+            if row.get("refreshed_at")
+        ]
+
+        return max(datetime.datetime.fromisoformat(stamp) for stamp in stamps)
+
+    @classmethod
+    def take_copy(cls, book_id: PydanticObjectId, session=None) -> bool:
+        # The stock check and decrement happen in one conditional update, so concurrent
+        # checkouts can never drive the stock below zero.
+        result = (
+            cls.find_one(cls.id == book_id, cls.stock > 0)
+            .update_one(
+                Inc({cls.stock: -1}),
+                Set({cls.updated_at: datetime.datetime.now()}),
+                session=session,
+            )
+            .run()
+        )
+
+        return result.modified_count == 1
+
+    @classmethod
+    def find_by_identifiers(cls, identifiers: list[str], session=None) -> dict:
+        # Desk staff scan ISBNs or paste ids; both kinds are resolved in a single query
+        ids = [PydanticObjectId(value) for value in identifiers if ObjectId.is_valid(value)]
+        isbns = [normalize_isbn(value) for value in identifiers if not ObjectId.is_valid(value)]
+        books = cls.find(
+            {"$or": [{"_id": {"$in": ids}}, {"isbn": {"$in": isbns}}]}, session=session
+        ).run()
+
+        by_key = {}
+        for book in books:
+            by_key[str(book.id)] = book
+            by_key[book.isbn] = book
+
+        return {
+            value: by_key.get(value if ObjectId.is_valid(value) else normalize_isbn(value))
+            for value in identifiers
+        }
+
+    @classmethod
+    def put_back_copy(cls, book_id: PydanticObjectId, session=None) -> Optional[dict]:
+        # Hands back the title and genre the circulation rollups are keyed by
+        return cls.get_motor_collection().find_one_and_update(
+            {"_id": book_id},
+            {"$inc": {"stock": 1}, "$set": {"updated_at": datetime.datetime.now().isoformat()}},
+            projection={"title": 1, "genre": 1},
+            session=session,
+        )
+
+    @classmethod
+    def add_rating(cls, book_id: PydanticObjectId, rating: int, session=None):
+        # A single $inc needs no prior read, so concurrent reviews never overwrite each other
+        cls.find_one(cls.id == book_id).update_one(
+            Inc({cls.review_count: 1, cls.rating_sum: rating, f"rating_histogram.{rating}": 1}),
+            Set({cls.updated_at: datetime.datetime.now()}),
+            session=session,
+        ).run()
+
+
+class BookCard(BaseModel):
+    id: PydanticObjectId = Field(alias="_id")
+    title: str
+    authors: list[str]
+    genre: str
+    publication_date: datetime.date
+    pages: int
+    stock: int
+    initial_stock: int
+    updated_at: datetime.datetime
+    cover_url: Optional[str] = None
+
+    class Settings:
+        projection = {
+            "title": 1,
+            "authors": 1,
+            "genre": 1,
+            "publication_date": 1,
+            "pages": 1,
+            "stock": 1,
+            "initial_stock": 1,
+            "updated_at": 1,
+            "cover_url": {"$arrayElemAt": ["$images_urls", 0]},
+        }
+
+    @property
+    def detail_url(self):
+        return url_for("books.book_detail", book_id=self.id)
+
+
+# publication_date is stored as an ISO string, so the year is its first four characters
+PUBLICATION_YEAR = {"$toInt": {"$substrBytes": ["$publication_date", 0, 4]}}
+BOOK_FACETS = {
+    "genres": [{"$group": {"_id": "$genre", "count": {"$sum": 1}}}],
+    "availability": [{"$group": {"_id": {"$gt": ["$stock", 0]}, "count": {"$sum": 1}}}],
+    "decades": [
+        {
+            "$group": {
+                "_id": {"$subtract": [PUBLICATION_YEAR, {"$mod": [PUBLICATION_YEAR, 10]}]},
+                "count": {"$sum": 1},
+            }
+        },
+        {"$sort": {"_id": 1}},
+    ],
+}
+
+# Paging through results or going back to a filter reuses the counts; stock changes from
+# rents in other processes show up once the entry expires.
+facet_cache = TTLCache(maxsize=1024, ttl=60)
+
+
+class BookFacets(BaseModel):
+    genres: dict[str, int]
+    available: int
+    unavailable: int
+    decades: dict[int, int]
+
+    @classmethod
+    def parse(cls, result: dict):
+        availability = {row["_id"]: row["count"] for row in result["availability"]}
+
+        return cls(
+            genres={row["_id"]: row["count"] for row in result["genres"]},
+            available=availability.get(True, 0),
+            unavailable=availability.get(False, 0),
+            decades={row["_id"]: row["count"] for row in result["decades"]},
+        )
+
+    @staticmethod
+    def cache_key(
+        title: str = None,
+        genre: str = None,
+        author: str = None,
+        available: bool = None,
+        isbn: str = None,
+        order_by: str = None,
+    ) -> tuple:
+        # The order does not change the counts, so it is left out of the key; the title is
+        # matched case-insensitively but otherwise as typed
+        return (
+            (title or "").casefold(),
+            genre or "",
+            normalize_author(author or ""),
+            bool(available),
+            normalize_isbn(isbn or ""),
+        )
+
+
+class AuthorSuggestion(BaseModel):
+    name: str
+    normalized: str
+    book_count: int
+
+    @property
+    def detail_url(self):
+        return url_for("books.author_detail", name=self.normalized)
+
+
+class Author(Document):
+    # Kept in sync with Book.authors by the views and the import that change books
+    name: str
+    normalized: str
+    keys: list[str]
+    book_ids: list[PydanticObjectId] = Field(default_factory=list)
+    book_count: int = 0
+
+    class Settings:
+        name = "authors"
+        indexes = [
+            IndexModel([("normalized", ASCENDING)], unique=True),
+            IndexModel([("keys", ASCENDING)]),
+        ]
+
+    @property
+    def detail_url(self):
+        return url_for("books.author_detail", name=self.normalized)
+
+    @classmethod
+    def sync(cls, changes: list[tuple[PydanticObjectId, list[str], list[str]]], session=None):
+        # changes are (book id, authors before, authors after). The updates are pipelines
+        # treating book_ids as a set, so applying the same change twice is harmless.
+        operations = []
+        removed = []
+        for book_id, old_authors, new_authors in changes:
+            old = {normalize_author(name) for name in old_authors if name.strip()}
+            new = {
+                normalize_author(name): " ".join(name.split())
+                for name in new_authors
+                if name.strip()
+            }
+
+            for key in old - new.keys():
+                removed.append(key)
+                operations.append(
+                    UpdateOne(
+                        {"normalized": key},
+                        [
+                            {
+                                "$set": {
+                                    "book_ids": {"$setDifference": ["$book_ids", [book_id]]}
+                                }
+                            },
+                            {"$set": {"book_count": {"$size": "$book_ids"}}},
+                        ],
+                    )
+                )
+
+            for key, name in new.items():
+                if key in old:
+                    continue
+                operations.append(
+                    UpdateOne(
+                        {"normalized": key},
+                        [
+                            {
+                                "$set": {
+                                    "name": {"$ifNull": ["$name", {"$literal": name}]},
+                                    "keys": {"$literal": author_keys(name)},
+                                    "book_ids": {
+                                        "$setUnion": [{"$ifNull": ["$book_ids", []]}, [book_id]]
+                                    },
+                                }
+                            },
+                            {"$set": {"book_count": {"$size": "$book_ids"}}},
+                        ],
+                        upsert=True,
+                    )
+                )
+
+        collection = cls.get_motor_collection()
+        if operations:
+            collection.bulk_write(operations, ordered=False, session=session)
+        if removed:
+            collection.delete_many(
+                {"normalized": {"$in": removed}, "book_count": 0}, session=session
+            )
+
+    @classmethod
+    def rebuild(cls, batch_size: int = 1000) -> int:
+        cls.get_motor_collection().delete_many({})
+
+        batch = []
+        books = Book.get_motor_collection().find({}, {"authors": 1}, batch_size=batch_size)
+        for book in books:
+            batch.append((book["_id"], [], book["authors"]))
+            if len(batch) >= batch_size:
+                cls.sync(batch)
+                batch.clear()
+        if batch:
+            cls.sync(batch)
+
+        return cls.get_motor_collection().count_documents({})
+
+    @classmethod
+    def get_by_name(cls, name: str) -> Optional["Author"]:
+        return cls.find_one(cls.normalized == normalize_author(name)).run()
+
+    @classmethod
+    def autocomplete(cls, text: str, limit: int = AUTOCOMPLETE_LIMIT):
+        # Matches come in index order; several keys of one author still return it once
+        return (
+            cls.find(prefix(cls.keys, normalize_author(text)))
+            .limit(limit)
+            .project(AuthorSuggestion)
+        )
+
+    @classmethod
+    def find_book_ids(
+        cls, text: str, limit: int = AUTHOR_MATCHES, book_limit: int = AUTHOR_BOOK_MATCHES
+    ) -> list[PydanticObjectId]:
+        # De-duplicated and capped on the server, so a short prefix matching prolific
+        # authors neither ships all their books over nor builds a huge $in
+        pipeline = [
+            {"$match": prefix(cls.keys, normalize_author(text))},
+            {"$limit": limit},
+            {"$unwind": "$book_ids"},
+            {"$group": {"_id": "$book_ids"}},
+            {"$limit": book_limit},
+        ]
+
+        return [group["_id"] for group in cls.get_motor_collection().aggregate(pipeline)]
+
+
+class BatchRentError(Exception):
+    def __init__(self, errors: dict[str, str]):
+        super().__init__(errors)
+        self.errors = errors
+
+
+# return_date is always stored (as null while the book is out), so matching on its type
+# selects exactly the open rents and lets queries use the partial index below.
+OPEN_RENT = {"return_date": {"$type": "null"}}
+# Link fields are stored as DBRefs, whose "$id" cannot be written as a field path
+BOOK_ID = {"$getField": {"field": {"$literal": "$id"}, "input": "$book"}}
+USER_ID = {"$getField": {"field": {"$literal": "$id"}, "input": "$user"}}
+
+SIMILAR_BOOKS = 6
+SIMILARITY_CANDIDATES = 50
+RECOMMENDATIONS_LAG = datetime.timedelta(minutes=1)
 
 
 class Rent(Document):
@@ -175,21 +669,891 @@ class Rent(Document):
 
     class Settings:
         bson_encoders = {**datetime_encoders}
+        indexes = [
+            IndexModel(
+                [("book.$id", ASCENDING), ("user.$id", ASCENDING), ("return_date", ASCENDING)]
+            ),
+            IndexModel(
+                [
+                    ("user.$id", ASCENDING),
+                    ("rent_date", DESCENDING),
+                    ("_id", DESCENDING),
+                    ("return_date", ASCENDING),
+                ]
+            ),
+            IndexModel(
+                [("user.$id", ASCENDING), ("rent_date", DESCENDING), ("_id", DESCENDING)],
+                name="open_rents_by_user",
+                partialFilterExpression=OPEN_RENT,
+            ),
+            IndexModel(
+                [("book.$id", ASCENDING), ("user.$id", ASCENDING)],
+                name="open_rents_unique",
+                unique=True,
+                partialFilterExpression=OPEN_RENT,
+            ),
+            IndexModel(
+                [("due_date", ASCENDING)],
+                name="open_rents_due_date",
+                partialFilterExpression=OPEN_RENT,
+            ),
+        ]
+
+    @property
+    def is_overdue(self):
+        return not self.return_date and self.due_date < datetime.date.today()
+
+    @classmethod
+    def checkout(cls, book: Book, user: User, session=None) -> Optional["Rent"]:
+        if not Book.take_copy(book.id, session=session):
+            return None
+
+        # Raises DuplicateKeyError if the user already has this book (open_rents_unique)
+        rent = cls(book=book, user=user)
+        rent.insert(session=session)
+        CirculationStats.record(
+            [CirculationStats.rented(book.id, book.title, book.genre)], session=session
+        )
+
+        return rent
+
+    @classmethod
+    def checkout_many(cls, user: User, identifiers: list[str], session=None) -> list["Rent"]:
+        # All or nothing: every book is checked first, then the stock of all of them is
+        # decremented with one update and the rents are written with one insert.
+        books = Book.find_by_identifiers(identifiers, session=session)
+        found = {book.id: book for book in books.values() if book}
+        open_rents = cls.find(
+            cls.user.id == user.id, In(cls.book.id, list(found)), OPEN_RENT, session=session
+        ).run()
+        rented = {rent.book.ref.id for rent in open_rents}
+
+        errors = {}
+        for value, book in books.items():
+            if not book:
+                errors[value] = "not found"
+            elif book.id in rented:
+                errors[value] = "already rented by this member"
+            elif book.stock < 1:
+                errors[value] = "no copies available"
+        if errors:
+            raise BatchRentError(errors)
+
+        result = (
+            Book.find(In(Book.id, list(found)), Book.stock > 0, session=session)
+            .update(
+                Inc({Book.stock: -1}),
+                Set({Book.updated_at: datetime.datetime.now()}),
+                session=session,
+            )
+            .run()
+        )
+        if result.modified_count != len(found):
+            raise BatchRentError({"": "stock changed in the meantime, try again"})
+
+        rents = [cls(book=book, user=user) for book in found.values()]
+        cls.insert_many(rents, session=session)
+        CirculationStats.record(
+            [
+                CirculationStats.rented(book.id, book.title, book.genre)
+                for book in found.values()
+            ],
+            session=session,
+        )
+
+        return rents
+
+    @classmethod
+    def checkin_many(cls, user: User, identifiers: list[str], session=None) -> int:
+        books = Book.find_by_identifiers(identifiers, session=session)
+        found = {book.id: book for book in books.values() if book}
+        open_rents = cls.find(
+            cls.user.id == user.id, In(cls.book.id, list(found)), OPEN_RENT, session=session
+        ).run()
+        rented = {rent.book.ref.id for rent in open_rents}
+
+        errors = {}
+        for value, book in books.items():
+            if not book:
+                errors[value] = "not found"
+            elif book.id not in rented:
+                errors[value] = "not rented by this member"
+        if errors:
+            raise BatchRentError(errors)
+
+        cls.find(
+            In(cls.id, [rent.id for rent in open_rents]), OPEN_RENT, session=session
+        ).update(Set({cls.return_date: datetime.date.today()}), session=session).run()
+        Book.find(In(Book.id, list(found)), session=session).update(
+            Inc({Book.stock: 1}),
+            Set({Book.updated_at: datetime.datetime.now()}),
+            session=session,
+        ).run()
+        OverdueRent.find(
+            OverdueRent.user_id == user.id,
+            In(OverdueRent.book_id, list(found)),
+            session=session,
+        ).delete(session=session).run()
+        CirculationStats.record(
+            [
+                CirculationStats.returned(
+                    rent.book.ref.id,
+                    found[rent.book.ref.id].title,
+                    found[rent.book.ref.id].genre,
+                    rent.rent_date,
+                    rent.due_date,
+                )
+                for rent in open_rents
+            ],
+            session=session,
+        )
+
+        return len(open_rents)
+
+    @classmethod
+    def checkin(
+        cls, book_id: PydanticObjectId, user_id: PydanticObjectId, session=None
+    ) -> bool:
+        # The document from before the update carries the dates the loan is measured by
+        rent = cls.get_motor_collection().find_one_and_update(
+            {"book.$id": book_id, "user.$id": user_id, **OPEN_RENT},
+            {"$set": {"return_date": datetime.date.today().isoformat()}},
+            projection={"rent_date": 1, "due_date": 1},
+            session=session,
+        )
+
+        if not rent:
+            return False
+
+        book = Book.put_back_copy(book_id, session=session)
+        OverdueRent.find(OverdueRent.book_id == book_id, OverdueRent.user_id == user_id).delete(
+            session=session
+        ).run()
+        CirculationStats.record(
+            [
+                CirculationStats.returned(
+                    book_id,
+                    book["title"],
+                    book["genre"],
+                    datetime.date.fromisoformat(rent["rent_date"]),
+                    datetime.date.fromisoformat(rent["due_date"]),
+                )
+            ],
+            session=session,
+        )
+
+        return True
+
+    @classmethod
+    def get_history(cls, user_id: PydanticObjectId, returned: bool):
+        # Open rents are served by the small partial index; returned ones walk the user's
+        # rents in rent_date order and are told apart by the return_date stored in the key.
+        status = {"return_date": {"$ne": None}} if returned else OPEN_RENT
+
+        return (
+            cls.find(cls.user.id == user_id, status)
+            .sort(-cls.rent_date, -cls.id)
+            .project(RentHistoryRow)
+        )
+
+
+class RentedBook(BaseModel):
+    id: PydanticObjectId = Field(alias="_id")
+    title: str
+    authors: list[str]
+
+    @property
+    def detail_url(self):
+        return url_for("books.book_detail", book_id=self.id)
+
+    def return_url(self, user_id: str):
+        return url_for("books.return_book", book_id=self.id, user_id=user_id)
+
+
+class RentHistoryRow(BaseModel):
+    id: PydanticObjectId = Field(alias="_id")
+    # None once the book has been removed from the catalogue; the rent itself is kept
+    book: Optional[RentedBook] = None
+    rent_date: datetime.date
+    due_date: datetime.date
+    return_date: Optional[datetime.date] = None
+
+    class Settings:
+        projection = {
+            "rent_date": 1,
+            "due_date": 1,
+            "return_date": 1,
+            "book": {"$arrayElemAt": ["$book", 0]},
+        }
+
+    @staticmethod
+    def lookup_stages() -> list[dict]:
+        # Runs after $limit, so only the rents of the page are joined, and only the
+        # fields the history shows are read from each book
+        return [
+            {
+                "$lookup": {
+                    "from": Book.get_motor_collection().name,
+                    "localField": "book.$id",
+                    "foreignField": "_id",
+                    "pipeline": [{"$project": {"title": 1, "authors": 1}}],
+                    "as": "book",
+                }
+            }
+        ]
 
     @property
     def is_overdue(self):
         return not self.return_date and self.due_date < datetime.date.today()
 
+
+class OverdueRent(Document):
+    # _id is the id of the overdue Rent; book and member details are copied at sweep time
+    book_id: PydanticObjectId
+    book_title: str
+    user_id: PydanticObjectId
+    first_name: str
+    last_name: str
+    email: str
+    phone_number: str
+    rent_date: datetime.date
+    due_date: datetime.date
+    refreshed_at: datetime.datetime
+
+    class Settings:
+        name = "overdue_rents"
+        bson_encoders = {**datetime_encoders}
+        indexes = [
+            IndexModel([("due_date", ASCENDING), ("_id", ASCENDING)]),
+            IndexModel([("book_id", ASCENDING), ("user_id", ASCENDING)]),
+        ]
+
+    @property
+    def full_name(self):
+        return f"{self.first_name} {self.last_name}"
+
+    @property
+    def book_url(self):
+        return url_for("books.book_detail", book_id=self.book_id)
+
+    @property
+    def member_url(self):
+        return url_for("auth.user_details", user_id=self.user_id)
+
+    @classmethod
+    def sweep(cls) -> int:
+        # Rents only become overdue as days pass, so a daily run picks up the new ones and
+        # refreshes the copied details; returns remove their entry as they happen.
+        refreshed_at = datetime.datetime.now().isoformat()
+        pipeline = [
+            {"$match": {**OPEN_RENT, "due_date": {"$lt": datetime.date.today().isoformat()}}},
+            {
+                "$lookup": {
+                    "from": Book.get_motor_collection().name,
+                    "localField": "book.$id",
+                    "foreignField": "_id",
+                    "as": "book",
+                }
+            },
+            {"$unwind": "$book"},
+            {
+                "$lookup": {
+                    "from": User.get_motor_collection().name,
+                    "localField": "user.$id",
+                    "foreignField": "_id",
+                    "as": "user",
+                }
+            },
+            {"$unwind": "$user"},
+            {
+                "$project": {
+                    "book_id": "$book._id",
+                    "book_title": "$book.title",
+                    "user_id": "$user._id",
+                    "first_name": "$user.first_name",
+                    "last_name": "$user.last_name",
+                    "email": "$user.email",
+                    "phone_number": "$user.phone_number",
+                    "rent_date": 1,
+                    "due_date": 1,
+                    "refreshed_at": {"$literal": refreshed_at},
+                }
+            },
+            {"$merge": {"into": cls.get_motor_collection().name, "whenMatched": "replace"}},
+        ]
+
+        Rent.get_motor_collection().aggregate(pipeline)
+        cls.get_motor_collection().delete_many({"refreshed_at": {"$lt": refreshed_at}})
+
+        return cls.get_motor_collection().count_documents({})
+
+
+class CirculationEvent(NamedTuple):
+    book_id: PydanticObjectId
+    title: str
+    genre: str
+    counts: dict[str, int]
+
+
+class CirculationStats(Document):
+    # One document per day for every book ("book" scope, keyed by id) and every genre
+    # ("genre" scope), incremented by checkouts and returns once their transaction commits.
+    scope: str
+    key: str
+    day: datetime.date
+    title: Optional[str] = None
+    genre: Optional[str] = None
+    rents: int = 0
+    returns: int = 0
+    late_returns: int = 0
+    loan_days: int = 0
+
+    class Settings:
+        name = "circulation_stats"
+        bson_encoders = {**datetime_encoders}
+        indexes = [
+            IndexModel(
+                [("scope", ASCENDING), ("key", ASCENDING), ("day", ASCENDING)], unique=True
+            ),
+            IndexModel([("scope", ASCENDING), ("day", ASCENDING)]),
+        ]
+
+    @staticmethod
+    def rented(book_id: PydanticObjectId, title: str, genre: str) -> CirculationEvent:
+        return CirculationEvent(book_id, title, genre, {"rents": 1})
+
+    @staticmethod
+    def returned(
+        book_id: PydanticObjectId,
+        title: str,
+        genre: str,
+        rent_date: datetime.date,
+        due_date: datetime.date,
+    ) -> CirculationEvent:
+        today = datetime.date.today()
+        counts = {
+            "returns": 1,
+            "late_returns": int(today > due_date),
+            "loan_days": (today - rent_date).days,
+        }
+
+        return CirculationEvent(book_id, title, genre, counts)
+
+    @classmethod
+    def record(cls, events: list[CirculationEvent], session=None):
+        day = datetime.date.today().isoformat()
+        increments = defaultdict(Counter)
+        labels = {}
+        for event in events:
+            increments[("book", str(event.book_id))].update(event.counts)
+            increments[("genre", event.genre)].update(event.counts)
+            labels[str(event.book_id)] = {"title": event.title, "genre": event.genre}
+
+        operations = []
+        for (scope, key), counts in increments.items():
+            update = {"$inc": dict(counts)}
+            if scope == "book":
+                update["$set"] = labels[key]
+            operations.append(
+                UpdateOne({"scope": scope, "key": key, "day": day}, update, upsert=True)
+            )
+
+        # Every checkout of a genre increments the same document, so inside the transaction
+        # concurrent desks would conflict on it. A write lost after the commit is repaired by
+        # `books backfill-stats`.
+        if operations:
+            after_commit(
+                session,
+                lambda: cls.get_motor_collection().bulk_write(operations, ordered=False),
+            )
+
     @classmethod
-    def get_overdue(cls):
-        return cls.find(
-            cls.return_date == None,  # noqa
-            cls.due_date < datetime.date.today(),
+    def backfill(cls, since: datetime.date = None) -> int:
+        # Rebuilds the rollups from the rent history. Every ISO date string sorts after "",
+        # so without a start day the whole history is rebuilt.
+        collection = cls.get_motor_collection()
+        since = since.isoformat() if since else ""
+        collection.delete_many({"day": {"$gte": since}})
+
+        with_book = [
+            {
+                "$lookup": {
+                    "from": Book.get_motor_collection().name,
+                    "localField": "book.$id",
+                    "foreignField": "_id",
+                    "as": "book",
+                }
+            },
+            {"$unwind": "$book"},
+        ]
+        into_book_scope = [
+            {
+                "$addFields": {
+                    "_id": "$$REMOVE",
+                    "scope": {"$literal": "book"},
+                    "key": {"$toString": "$_id.book_id"},
+                    "day": "$_id.day",
+                }
+            },
+            {
+                "$merge": {
+                    "into": collection.name,
+                    "on": ["scope", "key", "day"],
+                    "whenMatched": "merge",
+                }
+            },
+        ]
+        loan_days = {
+            "$toInt": {
+                "$divide": [
+                    {
+                        "$subtract": [
+                            {"$dateFromString": {"dateString": "$return_date"}},
+                            {"$dateFromString": {"dateString": "$rent_date"}},
+                        ]
+                    },
+                    24 * 60 * 60 * 1000,
+                ]
+            }
+        }
+
+        rents = Rent.get_motor_collection()
+        rents.aggregate(
+            [
+                {"$match": {"rent_date": {"$gte": since}}},
+                *with_book,
+                {
+                    "$group": {
+                        "_id": {"book_id": "$book._id", "day": "$rent_date"},
+                        "title": {"$first": "$book.title"},
+                        "genre": {"$first": "$book.genre"},
+                        "rents": {"$sum": 1},
+                    }
+                },
+                *into_book_scope,
+            ],
+            allowDiskUse=True,
+        )
+        # Returned rents hold a date string, open ones hold null, which $gte "" skips
+        rents.aggregate(
+            [
+                {"$match": {"return_date": {"$gte": since}}},
+                *with_book,
+                {
+                    "$group": {
+                        "_id": {"book_id": "$book._id", "day": "$return_date"},
+                        "title": {"$first": "$book.title"},
+                        "genre": {"$first": "$book.genre"},
+                        "returns": {"$sum": 1},
+                        "late_returns": {
+                            "$sum": {"$cond": [{"$gt": ["$return_date", "$due_date"]}, 1, 0]}
+                        },
+                        "loan_days": {"$sum": loan_days},
+                    }
+                },
+                *into_book_scope,
+            ],
+            allowDiskUse=True,
+        )
+        collection.aggregate(
+            [
+                {"$match": {"scope": "book", "day": {"$gte": since}}},
+                {
+                    "$group": {
+                        "_id": {"genre": "$genre", "day": "$day"},
+                        **{
+                            counter: {"$sum": f"${counter}"}
+                            for counter in ("rents", "returns", "late_returns", "loan_days")
+                        },
+                    }
+                },
+                {
+                    "$addFields": {
+                        "_id": "$$REMOVE",
+                        "scope": {"$literal": "genre"},
+                        "key": "$_id.genre",
+                        "day": "$_id.day",
+                    }
+                },
+                {
+                    "$merge": {
+                        "into": collection.name,
+                        "on": ["scope", "key", "day"],
+                        "whenMatched": "replace",
+                    }
+                },
+            ],
+            allowDiskUse=True,
         )
 
+        return collection.count_documents({"day": {"$gte": since}})
+
+    @classmethod
+    def summary(cls, since: datetime.date, top: int = 10) -> "CirculationSummary":
+        counters = {
+            counter: {"$sum": f"${counter}"}
+            for counter in ("rents", "returns", "late_returns", "loan_days")
+        }
+        pipeline = [
+            {
+                "$match": {
+                    "scope": {"$in": ["book", "genre"]},
+                    "day": {"$gte": since.isoformat()},
+                }
+            },
+            {
+                "$facet": {
+                    "genres": [
+                        {"$match": {"scope": "genre"}},
+                        {"$group": {"_id": "$key", **counters}},
+                        {"$sort": {"rents": -1, "_id": 1}},
+                    ],
+                    "books": [
+                        {"$match": {"scope": "book"}},
+                        {
+                            "$group": {
+                                "_id": "$key",
+                                "title": {"$last": "$title"},
+                                "genre": {"$last": "$genre"},
+                                **counters,
+                            }
+                        },
+                        {"$sort": {"rents": -1, "_id": 1}},
+                        {"$limit": top},
+                    ],
+                    "days": [
+                        {"$match": {"scope": "genre"}},
+                        {"$group": {"_id": "$day", **counters}},
+                        {"$sort": {"_id": 1}},
+                    ],
+                }
+            },
+        ]
+
+        return CirculationSummary.parse_obj(
+            next(cls.get_motor_collection().aggregate(pipeline))
+        )
+
+
+class CirculationRow(BaseModel):
+    key: str = Field(alias="_id")
+    title: Optional[str] = None
+    genre: Optional[str] = None
+    rents: int = 0
+    returns: int = 0
+    late_returns: int = 0
+    loan_days: int = 0
+
+    @property
+    def detail_url(self):
+        return url_for("books.book_detail", book_id=self.key)
+
+    @property
+    def avg_loan_days(self):
+        if not self.returns:
+            return Decimal(0)
+
+        return round(Decimal(self.loan_days) / self.returns, 1)
+
+    @property
+    def late_rate(self):
+        if not self.returns:
+            return Decimal(0)
+
+        return round(Decimal(100 * self.late_returns) / self.returns, 1)
+
+
+class CirculationSummary(BaseModel):
+    genres: list[CirculationRow]
+    books: list[CirculationRow]
+    days: list[CirculationRow]
+
+    @property
+    def total(self):
+        return CirculationRow(
+            _id="total",
+            **{
+                counter: sum(getattr(day, counter) for day in self.days)
+                for counter in ("rents", "returns", "late_returns", "loan_days")
+            },
+        )
+
+
+class SimilarBook(BaseModel):
+    book_id: PydanticObjectId
+    title: str
+    score: float
+
+    @property
+    def detail_url(self):
+        return url_for("books.book_detail", book_id=self.book_id)
+
+
+class CoRent(Document):
+    # The sparse book x book co-occurrence matrix: how many members borrowed both a and b.
+    # Every pair is stored in both directions, so a book's row is one index range.
+    a: PydanticObjectId
+    b: PydanticObjectId
+    members: int
+    changed_at: datetime.datetime
+
+    class Settings:
+        name = "co_rents"
+        bson_encoders = {**datetime_encoders}
+        indexes = [
+            IndexModel([("a", ASCENDING), ("b", ASCENDING)], unique=True),
+            IndexModel([("a", ASCENDING), ("members", DESCENDING)]),
+            IndexModel([("changed_at", ASCENDING)]),
+        ]
+
+
+class RecommendationRun(Document):
+    # Rents up to `upto` are counted in co_rents; the next run starts after it
+    upto: PydanticObjectId
+    full: bool
+    rents: int
+    books: int
+    finished_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
+
+    class Settings:
+        name = "recommendation_runs"
+        bson_encoders = {**datetime_encoders}
+
+
+class BookRecommendations(Document):
+    # _id is the id of the book; borrowers counts the distinct members who rented it
+    borrowers: int = 0
+    similar: list[SimilarBook] = Field(default_factory=list)
+    refreshed_at: Optional[datetime.datetime] = None
+
+    class Settings:
+        name = "recommendations"
+        bson_encoders = {**datetime_encoders}
+
+    @classmethod
+    def refresh(cls, full: bool = False, top: int = SIMILAR_BOOKS) -> RecommendationRun:
+        last = (
+            None
+            if full
+            else RecommendationRun.find().sort(-RecommendationRun.id).limit(1).first_or_none()
+        )
+        after = last.upto if last else ObjectId("0" * 24)
+        # Rents commit inside transactions, so one with an older id can become visible after
+        # a newer one. Leaving the most recent ones to the next run keeps nothing behind.
+        upto = ObjectId.from_datetime(
+            datetime.datetime.now(datetime.timezone.utc) - RECOMMENDATIONS_LAG
+        )
+        stamp = datetime.datetime.now().isoformat()
+
+        rents = Rent.get_motor_collection()
+        co_rents = CoRent.get_motor_collection()
+        collection = cls.get_motor_collection()
+        if full:
+            co_rents.delete_many({})
+            collection.delete_many({})
+
+        # Per member: the books first borrowed in this run and everything borrowed before
+        new_borrowers = [
+            {"$match": {"_id": {"$gt": after, "$lte": upto}}},
+            {"$group": {"_id": USER_ID, "books": {"$addToSet": BOOK_ID}}},
+            {
+                "$lookup": {
+                    "from": rents.name,
+                    "localField": "_id",
+                    "foreignField": "user.$id",
+                    "pipeline": [
+                        {"$match": {"_id": {"$lte": after}}},
+                        {"$project": {"_id": 0, "book": BOOK_ID}},
+                    ],
+                    "as": "before",
+                }
+            },
+            {
+                "$project": {
+                    "before": "$before.book",
+                    "new": {"$setDifference": ["$books", "$before.book"]},
+                }
+            },
+            {"$match": {"new.0": {"$exists": True}}},
+        ]
+
+        rents.aggregate(
+            [
+                *new_borrowers,
+                {"$unwind": "$new"},
+                {"$group": {"_id": "$new", "borrowers": {"$sum": 1}}},
+                {
+                    "$merge": {
+                        "into": collection.name,
+                        "whenMatched": [
+                            {"$set": {"borrowers": {"$add": ["$borrowers", "$$new.borrowers"]}}}
+                        ],
+                    }
+                },
+            ],
+            allowDiskUse=True,
+        )
+        # Only pairs with at least one newly borrowed book change; a pair of two new books
+        # is produced once from each side, a new-old pair adds both directions at once.
+        rents.aggregate(
+            [
+                *new_borrowers,
+                {
+                    "$project": {
+                        "book": "$new",
+                        "new": 1,
+                        "other": {"$setUnion": ["$before", "$new"]},
+                    }
+                },
+                {"$unwind": "$book"},
+                {"$unwind": "$other"},
+                {"$match": {"$expr": {"$ne": ["$book", "$other"]}}},
+                {
+                    "$project": {
+                        "pairs": {
+                            "$cond": [
+                                {"$in": ["$other", "$new"]},
+                                [{"a": "$book", "b": "$other"}],
+                                [{"a": "$book", "b": "$other"}, {"a": "$other", "b": "$book"}],
+                            ]
+                        }
+                    }
+                },
+                {"$unwind": "$pairs"},
+                {"$group": {"_id": "$pairs", "members": {"$sum": 1}}},
+                {
+                    "$project": {
+                        "_id": 0,
+                        "a": "$_id.a",
+                        "b": "$_id.b",
+                        "members": 1,
+                        "changed_at": {"$literal": stamp},
+                    }
+                },
+                {
+                    "$merge": {
+                        "into": co_rents.name,
+                        "on": ["a", "b"],
+                        "whenMatched": [
+                            {
+                                "$set": {
+                                    "members": {"$add": ["$members", "$$new.members"]},
+                                    "changed_at": "$$new.changed_at",
+                                }
+                            }
+                        ],
+                    }
+                },
+            ],
+            allowDiskUse=True,
+        )
+        # Cosine similarity of the borrower sets, taken over each changed book's most
+        # frequent partners only, so a bestseller's row does not have to be sorted whole
+        co_rents.aggregate(
+            [
+                {"$match": {"changed_at": stamp}},
+                {"$group": {"_id": "$a"}},
+                {
+                    "$lookup": {
+                        "from": collection.name,
+                        "localField": "_id",
+                        "foreignField": "_id",
+                        "as": "self",
+                    }
+                },
+                {
+                    "$lookup": {
+                        "from": co_rents.name,
+                        "localField": "_id",
+                        "foreignField": "a",
+                        "pipeline": [
+                            {"$sort": {"members": -1}},
+                            {"$limit": SIMILARITY_CANDIDATES},
+                        ],
+                        "as": "pair",
+                    }
+                },
+                {"$unwind": "$pair"},
+                {
+                    "$lookup": {
+                        "from": collection.name,
+                        "localField": "pair.b",
+                        "foreignField": "_id",
+                        "as": "other",
+                    }
+                },
+                {
+                    "$lookup": {
+                        "from": Book.get_motor_collection().name,
+                        "localField": "pair.b",
+                        "foreignField": "_id",
+                        "pipeline": [{"$project": {"title": 1}}],
+                        "as": "book",
+                    }
+                },
+                {"$unwind": "$book"},
+                {
+                    "$project": {
+                        "book_id": "$pair.b",
+                        "title": "$book.title",
+                        "score": {
+                            "$divide": [
+                                "$pair.members",
+                                {
+                                    "$sqrt": {
+                                        "$multiply": [
+                                            {"$first": "$self.borrowers"},
+                                            {"$first": "$other.borrowers"},
+                                        ]
+                                    }
+                                },
+                            ]
+                        },
+                    }
+                },
+                {"$sort": {"_id": 1, "score": -1, "book_id": 1}},
+                {
+                    "$group": {
+                        "_id": "$_id",
+                        "similar": {
+                            "$push": {
+                                "book_id": "$book_id",
+                                "title": "$title",
+                                "score": "$score",
+                            }
+                        },
+                    }
+                },
+                {
+                    "$project": {
+                        "similar": {"$slice": ["$similar", top]},
+                        "refreshed_at": {"$literal": stamp},
+                    }
+                },
+                {
+                    "$merge": {
+                        "into": collection.name,
+                        "whenMatched": "merge",
+                        "whenNotMatched": "discard",
+                    }
+                },
+            ],
+            allowDiskUse=True,
+        )
+
+        run = RecommendationRun(
+            upto=upto,
+            full=full,
+            rents=rents.count_documents({"_id": {"$gt": after, "$lte": upto}}),
+            books=collection.count_documents({"refreshed_at": stamp}),
+        )
+        run.insert()
+
+        return run
+
 
 class Review(Document):
-    book_id: Indexed(PydanticObjectId)
+    book_id: PydanticObjectId
     user: Link[User]
     rating: int
     comment: str
@@ -197,3 +1561,31 @@ class Review(Document):
 
     class Settings:
         bson_encoders = {**datetime_encoders}
+        indexes = [
+            IndexModel([("book_id", ASCENDING), ("user.$id", ASCENDING)], unique=True),
+            IndexModel([("book_id", ASCENDING), ("created_at", DESCENDING)]),
+        ]
+
+
+class Reviewer(BaseModel):
+    first_name: str
+    last_name: str
+
+    @property
+    def full_name(self):
+        return f"{self.first_name} {self.last_name}"
+
+
+class ReviewDetails(BaseModel):
+    rating: int
+    comment: str
+    created_at: datetime.datetime
+    user: Reviewer
+
+
+class BookDetails(BaseModel):
+    book: Book
+    reviews: list[ReviewDetails]
+    already_rented: bool
+    review_added: bool
+    similar: list[SimilarBook]
@@ -1,31 +1,60 @@
 import datetime
+import io
 import math
 import random
-from decimal import Decimal
 
 from bunnet import PydanticObjectId
+from bunnet.odm.operators.find.comparison import In
 from faker import Faker
 from flask import abort
 from flask import Blueprint
 from flask import flash
+from flask import get_template_attribute
+from flask import jsonify
+from flask import make_response
 from flask import redirect
 from flask import render_template
 from flask import request
+from flask import Response
 from flask import url_for
 from flask_login import current_user
 from flask_login import login_required
+from pymongo.errors import DuplicateKeyError
 
-from library import mongo_client
 from library.auth.decorators import admin_role_required
 from library.auth.models import User
 from library.books.forms import AddBookForm
 from library.books.forms import AddReviewForm
+from library.books.forms import BatchRentForm
 from library.books.forms import FilterBooksForm
+from library.books.forms import ImportBooksForm
 from library.books.forms import ModifyBookForm
 from library.books.forms import RentBookForm
+from library.books.imports import detect_format
+from library.books.imports import import_books
+from library.books.imports import read_rows
+from library.books.models import Author
+from library.books.models import BatchRentError
 from library.books.models import Book
+from library.books.models import BOOK_FACETS
+from library.books.models import BookCard
+from library.books.models import BookFacets
+from library.books.models import BookOrders
+from library.books.models import CirculationStats
+from library.books.models import facet_cache
+from library.books.models import OverdueRent
 from library.books.models import Rent
 from library.books.models import Review
+from library.books.search import normalize_isbn
+from library.books.typeahead import title_typeahead
+from library.http_cache import cached_fragment
+from library.http_cache import etag_for
+from library.http_cache import not_modified
+from library.http_cache import with_validators
+from library.pagination import count_facets
+from library.pagination import paginate
+from library.profiling import query_budget
+from library.transactions import run_in_transaction
 
 books = Blueprint("books", __name__)
 
@@ -33,11 +62,30 @@ faker = Faker()
 
 faker = Faker()
 
+ANALYTICS_PERIODS = (7, 30, 90, 365)
+
+
+@books.app_template_global()
+def book_card(book):
+    return cached_fragment(
+        ("book_card", book.id, book.updated_at),
+        lambda: get_template_attribute("_book_cards.html", "render_book_card")(book),
+    )
+
+
+@books.app_template_global()
+def book_info(book):
+    return cached_fragment(
+        ("book_info", book.id, book.updated_at),
+        lambda: get_template_attribute("books/_book_info.html", "render_book_info")(book),
+    )
+
 
 @books.route("/books", methods=["GET"])
+@query_budget(4)
 @login_required
 def list_books():
-    page = request.args.get("page", 1, type=int)
+    page = request.args.get("page", None, type=int)
     page_size = request.args.get("page_size", 24, type=int)
 
     filters = {
@@ -51,45 +99,53 @@ def list_books():
     form = FilterBooksForm(**filters)
     filters_query_string = "&".join([f"{k}={v}" for k, v in filters.items() if v])
 
-    query = Book.filter(**filters)
-    books_ = query.skip((page - 1) * page_size).limit(page_size).run()
-    total = query.count()
-
-    pagination = {
-        "page": page,
-        "page_size": page_size,
-        "total": total,
-        "total_pages": math.ceil(total / page_size),
-    }
+    query = Book.filter(**filters).project(BookCard)
+    books_, pagination = paginate(
+        query,
+        page_size,
+        page=page,
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
 
-    return render_template(
-        "books/list_books.html",
-        form=form,
-        books=books_,
-        pagination=pagination,
-        filters_query_string=filters_query_string,
+    facet_key = BookFacets.cache_key(**filters)
+    facets = facet_cache.get(facet_key)
+    if not facets:
+        facets = BookFacets.parse(count_facets(query, BOOK_FACETS))
+        facet_cache.set(facet_key, facets)
+
+    etag = etag_for(
+        current_user.id,
+        current_user.is_admin,
+        request.full_path,
+        [(book.id, book.updated_at) for book in books_],
+        pagination,
+        facets,
     )
+    if not_modified(etag):
+        return with_validators(Response(status=304), etag)
+
+    form.show_counts(facets)
+    response = make_response(
+        render_template(
+            "books/list_books.html",
+            form=form,
+            books=books_,
+            facets=facets,
+            pagination=pagination,
+            filters_query_string=filters_query_string,
+        )
+    )
+
+    return with_validators(response, etag)
 
 
 @books.route("/books/<book_id>", methods=["GET", "POST"])
+@query_budget(4)
 @login_required
 def book_detail(book_id):
-    book = Book.get(book_id).run()
-    reviews = Review.find(Review.book_id == PydanticObjectId(book_id), fetch_links=True).run()
-
-    already_rented = bool(
-        Rent.find_one(
-            Rent.book.id == PydanticObjectId(book_id),
-            Rent.user.id == PydanticObjectId(current_user.id),
-        ).run()
-    )
-
-    review_added = bool(
-        Review.find_one(
-            Review.book_id == PydanticObjectId(book_id),
-            Review.user.id == PydanticObjectId(current_user.id),
-        ).run()
-    )
+    page = request.args.get("page", 1, type=int)
+    page_size = request.args.get("page_size", 10, type=int)
 
     form = RentBookForm()
     if request.method == "POST":
@@ -107,72 +163,179 @@ def book_detail(book_id):
 
         return redirect(url_for("books.rent_book", book_id=book_id, user_id=str(user.id)))
 
-    return render_template(
-        "books/book_detail.html",
-        book=book,
-        form=form,
-        reviews=reviews,
-        already_rented=already_rented,
-        review_added=review_added,
+    last_modified = Book.get_last_modified(book_id)
+    if not last_modified:
+        abort(404)
+
+    etag = etag_for(
+        book_id, last_modified, current_user.id, current_user.is_admin, page, page_size
     )
+    if not_modified(etag, last_modified):
+        return with_validators(Response(status=304), etag, last_modified)
+
+    details = Book.get_details(book_id, current_user.id, page=page, page_size=page_size)
+    if not details:
+        abort(404)
+
+    pagination = {
+        "mode": "offset",
+        "page": page,
+        "page_size": page_size,
+        "total": details.book.review_count,
+        "total_pages": math.ceil(details.book.review_count / page_size),
+    }
+
+    response = make_response(
+        render_template(
+            "books/book_detail.html",
+            book=details.book,
+            form=form,
+            reviews=details.reviews,
+            pagination=pagination,
+            already_rented=details.already_rented,
+            review_added=details.review_added,
+            similar=details.similar,
+        )
+    )
+
+    return with_validators(response, etag, last_modified)
 
 
 @books.route("/books/<book_id>/rent/<user_id>", methods=["GET"])
+@query_budget(8)
 @login_required
 @admin_role_required
 def rent_book(book_id, user_id):
     user = User.get(user_id).run()
     book = Book.get(book_id).run()
-    rent = Rent.find_one(
-        Rent.book.id == PydanticObjectId(book_id),
-        Rent.user.id == PydanticObjectId(user_id),
-        Rent.return_date == None,  # noqa
-    ).run()
 
     if not book or not user:
         raise abort(404)
 
-    if rent:
+    try:
+        rent = run_in_transaction(lambda session: Rent.checkout(book, user, session=session))
+    except DuplicateKeyError:
         flash("Book already rented", "danger")
         return redirect(book.detail_url)
 
-    if not book.is_available:
+    if not rent:
         raise abort(403)
 
-    with mongo_client.start_session() as session, session.start_transaction():
-        book.stock -= 1
-        book.save(session=session)
-        rent = Rent(book=book, user=user)
-        rent.save(session=session)
-
     flash("Book rented successfully", "success")
     return redirect(url_for("auth.user_details", user_id=user_id))
 
 
 @books.route("/books/<book_id>/return/<user_id>", methods=["GET"])
+@query_budget(6)
 @login_required
 @admin_role_required
 def return_book(book_id, user_id):
-    rent = Rent.find_one(
-        Rent.book.id == PydanticObjectId(book_id),
-        Rent.user.id == PydanticObjectId(user_id),
-        Rent.return_date == None,  # noqa
-    ).run()
+    returned = run_in_transaction(
+        lambda session: Rent.checkin(
+            PydanticObjectId(book_id), PydanticObjectId(user_id), session=session
+        )
+    )
 
-    if not rent:
+    if not returned:
         raise abort(404)
 
-    with mongo_client.start_session() as session, session.start_transaction():
-        book = Book.get(book_id).run()
-        book.stock += 1
-        book.save(session=session)
-        rent.return_date = datetime.date.today().isoformat()
-        rent.save(session=session)
-
     flash("Book returned successfully", "success")
     return redirect(url_for("auth.user_details", user_id=user_id))
 
 
+@books.route("/members/<user_id>/rents", methods=["POST"])
+@query_budget(8)
+@login_required
+@admin_role_required
+def batch_rents(user_id):
+    user = User.get(user_id).run()
+    if not user:
+        abort(404)
+
+    form = BatchRentForm()
+    if not form.validate_on_submit():
+        flash("Enter at least one book id or ISBN", "danger")
+        return redirect(user.details_url)
+
+    try:
+        if form.checkin.data:
+            count = run_in_transaction(
+                lambda session: Rent.checkin_many(user, form.identifiers, session=session)
+            )
+            flash(f"{count} books returned", "success")
+        else:
+            rents = run_in_transaction(
+                lambda session: Rent.checkout_many(user, form.identifiers, session=session)
+            )
+            flash(f"{len(rents)} books rented", "success")
+    except BatchRentError as error:
+        for value, message in error.errors.items():
+            flash(f"{value}: {message}" if value else message, "danger")
+
+    return redirect(user.details_url)
+
+
+@books.route("/books/typeahead", methods=["GET"])
+@query_budget(1)
+@login_required
+def title_suggestions():
+    text = request.args.get("q", "").strip()
+    if not text:
+        return jsonify([])
+
+    return jsonify(
+        [
+            {"title": title, "isbn": isbn, "url": url_for("books.book_detail", book_id=book_id)}
+            for book_id, title, isbn in title_typeahead.complete(text)
+        ]
+    )
+
+
+@books.route("/authors/autocomplete", methods=["GET"])
+@query_budget(2)
+@login_required
+def author_autocomplete():
+    text = request.args.get("q", "").strip()
+    if not text:
+        return jsonify([])
+
+    return jsonify(
+        [
+            {"name": author.name, "book_count": author.book_count, "url": author.detail_url}
+            for author in Author.autocomplete(text)
+        ]
+    )
+
+
+@books.route("/authors/<path:name>", methods=["GET"])
+@query_budget(4)
+@login_required
+def author_detail(name):
+    author = Author.get_by_name(name)
+    if not author:
+        abort(404)
+
+    page = request.args.get("page", None, type=int)
+    page_size = request.args.get("page_size", 24, type=int)
+
+    query = (
+        Book.find(In(Book.id, author.book_ids))
+        .sort(Book.order_keys(BookOrders.TITLE_ASC))
+        .project(BookCard)
+    )
+    books_, pagination = paginate(
+        query,
+        page_size,
+        page=page,
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
+
+    return render_template(
+        "books/author_detail.html", author=author, books=books_, pagination=pagination
+    )
+
+
 @books.route("/books/remove/<book_id>", methods=["GET"])
 @login_required
 @admin_role_required
@@ -180,6 +343,9 @@ def remove_book(book_id):
     try:
         book = Book.get(book_id).run()
         book.delete()
+        Author.sync([(book.id, book.authors, [])])
+        title_typeahead.remove(book.id)
+        facet_cache.clear()
         flash("Book has been removed", "success")
     except Exception:
         flash("Removing error", "error")
@@ -195,64 +361,106 @@ def add_book():
     if request.method == "POST" and form.validate_on_submit():
         book = Book(
             title=form.title.data,
-            authors=form.authors.data.split(","),
+            authors=[name.strip() for name in form.authors.data.split(",")],
             topic=form.topic.data,
             genre=form.genre.data,
             publication_date=form.publication_date.data,
             publisher=form.publisher.data,
             description=form.description.data,
-            isbn=form.isbn.data,
+            isbn=normalize_isbn(form.isbn.data),
             pages=form.pages.data,
             stock=form.stock.data,
             initial_stock=form.stock.data,
             images_urls=[faker.image_url() for _ in range(random.randint(1, 3))],
         )
-        book.authors = book.authors[0].split(",")
         book.save()
+        Author.sync([(book.id, [], book.authors)])
+        title_typeahead.update(book.id, book.title, book.isbn)
+        facet_cache.clear()
         flash("New book has been added", "success")
         return redirect(url_for("books.list_books"))
 
     return render_template("books/add_book.html", form=form)
 
 
+@books.route("/books/import", methods=["GET", "POST"])
+@login_required
+@admin_role_required
+def import_catalogue():
+    form = ImportBooksForm()
+    report = None
+    if form.validate_on_submit():
+        # Uploads are spooled to a temporary file by werkzeug and read back row by row
+        upload = form.file.data
+        stream = io.TextIOWrapper(upload.stream, encoding="utf-8-sig", newline="")
+        report = import_books(read_rows(stream, detect_format(upload.filename)))
+        flash(
+            f"{report.inserted} books added, {report.updated} updated, {report.failed} failed",
+            "success" if not report.failed else "warning",
+        )
+
+    return render_template("books/import_books.html", form=form, report=report)
+
+
 @books.route("/returns/overdue", methods=["GET"])
+@query_budget(3)
 @login_required
 @admin_role_required
 def overdue_returns():
-    page = request.args.get("page", 1, type=int)
+    page = request.args.get("page", None, type=int)
     page_size = request.args.get("page_size", 24, type=int)
 
-    query = Rent.get_overdue().find(fetch_links=True).sort(Rent.due_date)
-    rents = query.skip((page - 1) * page_size).limit(page_size).run()
-    total = query.count()
-
-    pagination = {
-        "page": page,
-        "page_size": page_size,
-        "total": total,
-        "total_pages": math.ceil(total / page_size),
-    }
+    query = OverdueRent.find().sort(OverdueRent.due_date)
+    rents, pagination = paginate(
+        query,
+        page_size,
+        page=page,
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
 
     return render_template("books/overdue_returns.html", rents=rents, pagination=pagination)
 
 
+@books.route("/analytics", methods=["GET"])
+@query_budget(3)
+@login_required
+@admin_role_required
+def analytics():
+    days = request.args.get("days", 30, type=int)
+    if days not in ANALYTICS_PERIODS:
+        days = 30
+
+    summary = CirculationStats.summary(
+        datetime.date.today() - datetime.timedelta(days=days - 1)
+    )
+
+    return render_template(
+        "books/analytics.html",
+        summary=summary,
+        overdue=OverdueRent.count(),
+        days=days,
+        periods=ANALYTICS_PERIODS,
+    )
+
+
 @books.route("/books/<book_id>/add_review", methods=["GET", "POST"])
 @login_required
 def add_review(book_id):
     book = Book.get(book_id).run()
 
+    if not book:
+        abort(404)
+
     review = Review.find_one(
         Review.book_id == PydanticObjectId(book_id),
         Review.user.id == PydanticObjectId(current_user.id),
     ).run()
 
     rent = Rent.find_one(
-        Review.book_id == PydanticObjectId(book_id),
-        Review.user.id == PydanticObjectId(current_user.id),
-    )
-
-    if not book:
-        abort(404)
+        Rent.book.id == PydanticObjectId(book_id),
+        Rent.user.id == PydanticObjectId(current_user.id),
+    ).run()
 
     if review:
         abort(403)
@@ -262,17 +470,22 @@ def add_review(book_id):
 
     form = AddReviewForm()
     if request.method == "POST" and form.validate_on_submit():
-        rating = Decimal(form.rating.data)
-        with mongo_client.start_session() as session, session.start_transaction():
-            review = Review(
-                book_id=book_id,
-                user=current_user,
-                rating=rating,
-                comment=form.comment.data,
-            )
-            book.add_review(rating)
-            book.save(session=session)
-            review.save(session=session)
+        rating = int(form.rating.data)
+        review = Review(
+            book_id=book_id,
+            user=current_user,
+            rating=rating,
+            comment=form.comment.data,
+        )
+
+        try:
+            review.insert()
+        except DuplicateKeyError:
+            abort(403)
+
+        # Not in a transaction with the insert: the $inc cannot conflict, and the
+        # aggregates can always be rebuilt with `flask books recompute-ratings`.
+        Book.add_rating(book.id, rating)
 
         flash("New review has been added", "success")
         return redirect(url_for("books.book_detail", book_id=book_id))
@@ -287,21 +500,26 @@ def modify_book(book_id):
     form = ModifyBookForm(book_id, override=request.method == "GET")
     if request.method == "POST" and form.validate_on_submit():
         book = Book.get(book_id).run()
+        old_authors = book.authors
         book.title = form.title.data
-        book.authors = form.authors.data.split(",")
+        book.authors = [name.strip() for name in form.authors.data.split(",")]
         book.topic = form.topic.data
         book.genre = form.genre.data
         book.publication_date = form.publication_date.data
         book.publisher = form.publisher.data
         book.description = form.description.data
-        book.isbn = form.isbn.data
+        book.isbn = normalize_isbn(form.isbn.data)
         book.pages = form.pages.data
         book.stock = form.stock.data
         book.initial_stock = form.stock.data
         book.images_urls = [faker.image_url() for _ in range(random.randint(1, 3))]
         book.initial_stock = form.initial_stock.data
+        book.updated_at = datetime.datetime.now()
 
         book.save()
+        Author.sync([(book.id, old_authors, book.authors)])
+        title_typeahead.update(book.id, book.title, book.isbn)
+        facet_cache.clear()
         flash("Book has been modified", "success")
         return redirect(url_for("books.list_books"))
 
@@ -0,0 +1,84 @@
+import re
+
+from bunnet.odm.operators.find.evaluation import RegEx
+from bunnet.odm.operators.find.evaluation import Text
+from pymongo import IndexModel
+from pymongo import TEXT
+
+ISBN_PATTERN = re.compile(r"^(\d{9}[\dX]|\d{13})$")
+
+TEXT_SCORE = ("score", {"$meta": "textScore"})
+
+# The text index drops these, so a $text search made only of them matches nothing
+STOP_WORDS = frozenset(
+    """
+    a about above after again against all am an and any are as at be because been before
+    being below between both but by can did do does doing down during each few for from
+    further had has have having he her here hers herself him himself his how i if in into
+    is it its itself just me more most my myself no nor not now of off on once only or
+    other our ours ourselves out over own same she should so some such than that the their
+    theirs them themselves then there these they this those through to too under until up
+    very was we were what when where which while who whom why will with you your yours
+    yourself yourselves
+    """.split()
+)
+
+# One text index per collection is allowed, so every searchable field shares it;
+# the weights decide how much a hit in each field contributes to the relevance score.
+text_index = IndexModel(
+    [("title", TEXT), ("authors", TEXT), ("topic", TEXT), ("description", TEXT)],
+    weights={"title": 10, "authors": 5, "topic": 2, "description": 1},
+    default_language="english",
+    name="book_text_search",
+)
+
+
+def normalize_title(title: str) -> str:
+    return " ".join(title.split()).casefold()
+
+
+def normalize_author(name: str) -> str:
+    return " ".join(name.split()).casefold()
+
+
+def author_keys(name: str) -> list[str]:
+    # The full name and every suffix starting at a word, so "tol" finds "J.R.R. Tolkien"
+    words = normalize_author(name).split(" ")
+    return [" ".join(words[i:]) for i in range(len(words))]
+
+
+def prefix(field, value: str) -> dict:
+    # An anchored, case-sensitive pattern is turned into a range scan of the index
+    return {str(field): {"$regex": "^" + re.escape(value)}}
+
+
+def normalize_isbn(value: str) -> str:
+    return re.sub(r"[\s-]", "", value).upper()
+
+
+def is_isbn(value: str) -> bool:
+    return bool(ISBN_PATTERN.match(normalize_isbn(value)))
+
+
+def title_words(title: str) -> list[str]:
+    # Stored on every book (Book.title_keys), so a word prefix is a range scan of their index
+    return list(dict.fromkeys(re.findall(r"\w+", title.casefold())))
+
+
+def whole_words(value: str) -> list[str]:
+    # Every word but the last is followed by more input, so it has to be a whole word of a
+    # matching title; the last one may still be a prefix ("Harr" for "Harry").
+    words = re.findall(r"\w+", value.casefold())
+    return [word for word in words[:-1] if word not in STOP_WORDS]
+
+
+def text_search(*terms: str) -> Text:
+    # Quotes and leading dashes are phrase/negation syntax in $search, not part of the query
+    return Text(" ".join(re.sub(r'["-]', " ", term) for term in terms if term))
+
+
+def word_prefix(field, value: str) -> RegEx:
+    # Matches the value at the start of any word, so "Witch" finds "The Witcher"; it only
+    # checks the candidates selected through the title word keys or the text index.
+    pattern = r"\s+".join(re.escape(word) for word in value.split())
+    return RegEx(field, r"(?<!\w)" + pattern, "i")
@@ -0,0 +1,157 @@
+import bisect
+import logging
+import re
+import threading
+
+from pymongo.errors import PyMongoError
+
+from library.books.models import Book
+from library.books.search import normalize_isbn
+from library.books.search import normalize_title
+
+logger = logging.getLogger(__name__)
+
+LOAD_BATCH_SIZE = 5000
+# create_app starts the load; a request arriving before it is done waits this long for it
+READY_TIMEOUT = 2
+ISBN_PREFIX = re.compile(r"^[\d\s-]+[xX]?$")
+# Only changes that can move a book in the index; stock and rating updates are skipped
+CHANGES = [
+    {
+        "$match": {
+            "$or": [
+                {"operationType": {"$in": ["insert", "replace", "delete"]}},
+                {"updateDescription.updatedFields.title": {"$exists": True}},
+                {"updateDescription.updatedFields.isbn": {"$exists": True}},
+            ]
+        }
+    }
+]
+
+
+class Typeahead:
+    # Normalized titles and ISBNs in one sorted array, completed by binary search. Each
+    # process keeps its own copy and follows the books change stream, so edits made by
+    # other workers and imports show up too.
+    def __init__(self):
+        self._keys = []
+        self._ids = []
+        self._books = {}
+        self._lock = threading.Lock()
+        self._started = False
+        self.ready = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        threading.Thread(target=self._run, name="typeahead", daemon=True).start()
+
+    def _run(self):
+        collection = Book.get_motor_collection()
+        try:
+            # Opened before loading, so changes made during the load are not missed
+            stream = collection.watch(CHANGES, full_document="updateLookup")
+        except PyMongoError as error:
+            logger.warning("Typeahead will only see this process's changes: %s", error)
+            stream = None
+
+        try:
+            self._load(collection)
+            if stream:
+                with stream:
+                    for change in stream:
+                        self._apply(change)
+        except PyMongoError:
+            logger.exception("Typeahead stopped following changes, it reloads on next use")
+            with self._lock:
+                self._started = False
+            self.ready.clear()
+
+    def _load(self, collection):
+        books = {}
+        entries = []
+        cursor = collection.find({}, {"title": 1, "isbn": 1}, batch_size=LOAD_BATCH_SIZE)
+        for book in cursor:
+            book_id = str(book["_id"])
+            books[book_id] = (book["title"], book["isbn"])
+            entries += [(key, book_id) for key in self._index_keys(book["title"], book["isbn"])]
+        entries.sort()
+
+        with self._lock:
+            self._keys = [key for key, _ in entries]
+            self._ids = [book_id for _, book_id in entries]
+            self._books = books
+        self.ready.set()
+        logger.info("Typeahead loaded %d books", len(books))
+
+    def _apply(self, change):
+        if change["operationType"] == "delete":
+            self.remove(change["documentKey"]["_id"])
+        elif change.get("fullDocument"):
+            book = change["fullDocument"]
+            self.update(book["_id"], book["title"], book["isbn"])
+
+    @staticmethod
+    def _index_keys(title: str, isbn: str) -> set[str]:
+        return {normalize_title(title), normalize_isbn(isbn)}
+
+    def _remove(self, book_id: str):
+        book = self._books.pop(book_id, None)
+        if not book:
+            return
+
+        for key in self._index_keys(*book):
+            index = bisect.bisect_left(self._keys, key)
+            while index < len(self._keys) and self._keys[index] == key:
+                if self._ids[index] == book_id:
+                    del self._keys[index]
+                    del self._ids[index]
+                    break
+                index += 1
+
+    def update(self, book_id, title: str, isbn: str):
+        book_id = str(book_id)
+        with self._lock:
+            self._remove(book_id)
+            self._books[book_id] = (title, isbn)
+            for key in self._index_keys(title, isbn):
+                index = bisect.bisect_right(self._keys, key)
+                self._keys.insert(index, key)
+                self._ids.insert(index, book_id)
+
+    def remove(self, book_id):
+        with self._lock:
+            self._remove(str(book_id))
+
+    def complete(self, text: str, limit: int = 10) -> list[tuple[str, str, str]]:
+        self.start()
+        self.ready.wait(READY_TIMEOUT)
+        prefixes = {normalize_title(text)}
+        if ISBN_PREFIX.match(text):
+            prefixes.add(normalize_isbn(text))
+
+        found = {}
+        with self._lock:
+            for prefix in prefixes:
+                index = bisect.bisect_left(self._keys, prefix)
+                while (
+                    index < len(self._keys)
+                    and len(found) < limit
+                    and self._keys[index].startswith(prefix)
+                ):
+                    book_id = self._ids[index]
+                    found.setdefault(book_id, self._books[book_id])
+                    index += 1
+
+        return [
+            (book_id, title, isbn) for book_id, (title, isbn) in list(found.items())[:limit]
+        ]
+
+    def __len__(self):
+        return len(self._books)
+
+
+title_typeahead = Typeahead()
@@ -0,0 +1,50 @@
+import click
+from flask.cli import AppGroup
+
+from library.exports import export
+from library.exports import EXPORTS
+from library.exports import FORMATS
+from library.indexes import diff
+from library.indexes import sync
+from library.models import document_models
+
+indexes = AppGroup("indexes", help="Compare and build the indexes declared on the models.")
+exports = AppGroup("export", help="Stream collections to NDJSON or CSV files.")
+
+
+def _print_diff(model, result):
+    click.echo(f"{model.__name__}:")
+    for name in result.missing:
+        click.echo(f"  + {name}")
+    for name in result.changed:
+        click.echo(f"  ~ {name}")
+    for name in result.extra:
+        click.echo(f"  - {name}")
+    if not any(result):
+        click.echo("  up to date")
+
+
+@indexes.command("diff")
+def diff_indexes():
+    """Show declared indexes that are missing (+), differ (~) or are not declared (-)."""
+    for model in document_models:
+        _print_diff(model, diff(model))
+
+
+@indexes.command("sync")
+@click.option("--drop", is_flag=True, help="Also drop changed and undeclared indexes.")
+def sync_indexes(drop):
+    """Build missing indexes, optionally replacing changed ones and dropping extra ones."""
+    for model in document_models:
+        _print_diff(model, sync(model, drop=drop))
+
+
+@exports.command("run")
+@click.argument("name", type=click.Choice(list(EXPORTS)))
+@click.option("--format", "file_format", type=click.Choice(FORMATS), default="ndjson")
+@click.option("--gzip", "compress", is_flag=True, help="Compress the output with gzip.")
+@click.option("--output", type=click.File("wb"), default="-", help="Defaults to stdout.")
+def export_collection(name, file_format, compress, output):
+    """Write every document of NAME to OUTPUT, reading it through a server-side cursor."""
+    for chunk in export(name, file_format, compress=compress):
+        output.write(chunk)
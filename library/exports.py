@@ -0,0 +1,112 @@
+import csv
+import io
+import json
+import zlib
+
+from pydantic import BaseModel
+
+from library.auth.models import User
+from library.books.models import Book
+from library.books.models import Rent
+from library.utils import json_default
+
+FORMATS = ("ndjson", "csv")
+BATCH_SIZE = 2000
+CHUNK_SIZE = 64 * 1024
+# Same separator the CSV import expects for list columns
+LIST_SEPARATOR = ";"
+
+EXPORTS = {
+    "books": (Book, {}),
+    "rents": (Rent, {}),
+    "members": (User, {"password": 0}),
+}
+
+
+def columns(model, projection: dict) -> list[str]:
+    names = []
+    for field in model.__fields__.values():
+        if field.alias == "revision_id" or field.alias in projection:
+            continue
+        if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            names += [f"{field.alias}.{sub.alias}" for sub in field.type_.__fields__.values()]
+        else:
+            names.append(field.alias)
+
+    return names
+
+
+def _cell(document: dict, column: str):
+    value = document
+    for part in column.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return LIST_SEPARATOR.join(str(_cell({"v": item}, "v")) for item in value)
+    if isinstance(value, dict):
+        return json.dumps(value, default=json_default)
+    if isinstance(value, (str, int, float)):
+        return value
+    return json_default(value)
+
+
+def _documents(collection, projection: dict, batch_size: int):
+    # Closing the generator (e.g. the client went away mid-download) kills the cursor
+    with collection.find({}, projection or None, batch_size=batch_size) as cursor:
+        yield from cursor
+
+
+def _ndjson(cursor):
+    encode = json.JSONEncoder(default=json_default, separators=(",", ":")).encode
+    for document in cursor:
+        yield encode(document) + "\n"
+
+
+def _csv(cursor, names: list[str]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for document in cursor:
+        writer.writerow([_cell(document, name) for name in names])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _chunked(lines):
+    # One write per row would turn into one tiny chunk per row on the wire
+    chunk, size = [], 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield "".join(chunk).encode()
+            chunk, size = [], 0
+    if chunk:
+        yield "".join(chunk).encode()
+
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export(name: str, file_format: str, compress: bool = False, batch_size: int = BATCH_SIZE):
+    # Raw documents from a server-side cursor: the stored values are already what the
+    # datetime_encoders produce, so there is no need to build and re-encode models.
+    model, projection = EXPORTS[name]
+    cursor = _documents(model.get_motor_collection(), projection, batch_size)
+
+    if file_format == "csv":
+        lines = _csv(cursor, columns(model, projection))
+    else:
+        lines = _ndjson(cursor)
+
+    chunks = _chunked(lines)
+    return _gzipped(chunks) if compress else chunks
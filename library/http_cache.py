@@ -0,0 +1,56 @@
+import datetime
+import hashlib
+
+from flask import request
+from flask import Response
+from flask import session
+from markupsafe import Markup
+
+from library.cache import TTLCache
+
+# Keys carry the document's updated_at, so an edited document simply stops matching its old
+# entry; the TTL and size only bound how long the stale ones linger.
+fragment_cache = TTLCache(maxsize=4096, ttl=3600)
+
+
+def cached_fragment(key: tuple, render) -> Markup:
+    html = fragment_cache.get(key)
+    if html is None:
+        html = Markup(render())
+        fragment_cache.set(key, html)
+
+    return html
+
+
+def etag_for(*parts) -> str:
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def _http_date(value: datetime.datetime) -> datetime.datetime:
+    # Stored timestamps are naive local time; HTTP dates are UTC with whole seconds
+    return value.astimezone(datetime.timezone.utc).replace(microsecond=0)
+
+
+def not_modified(etag: str, last_modified: datetime.datetime = None) -> bool:
+    # A pending flash message has to be rendered, so that response cannot be skipped
+    if "_flashes" in session:
+        return False
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified and request.if_modified_since:
+        return _http_date(last_modified) <= request.if_modified_since
+
+    return False
+
+
+def with_validators(
+    response: Response, etag: str, last_modified: datetime.datetime = None
+) -> Response:
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = _http_date(last_modified)
+    # Pages differ per member, so only the browser may keep them, and it has to revalidate
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+    return response
@@ -0,0 +1,105 @@
+import logging
+from typing import NamedTuple
+
+from bunnet.odm.utils.init import Initializer
+from pymongo import IndexModel
+from pymongo import TEXT
+
+logger = logging.getLogger(__name__)
+
+INDEX_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+
+class IndexDiff(NamedTuple):
+    missing: list[str]
+    changed: list[str]
+    extra: list[str]
+
+
+def declared_indexes(model) -> dict[str, IndexModel]:
+    # Same sources bunnet reads on init: Indexed() fields and Settings.indexes
+    indexes = [
+        IndexModel([(field.alias, field.type_._indexed[0])], **field.type_._indexed[1])
+        for field in model.__fields__.values()
+        if getattr(field.type_, "_indexed", None)
+    ]
+    indexes += model.get_settings().indexes
+
+    return {index.document["name"]: index for index in indexes}
+
+
+def existing_indexes(model) -> dict[str, dict]:
+    indexes = model.get_motor_collection().index_information()
+    indexes.pop("_id_", None)
+
+    return indexes
+
+
+def _matches(declared: IndexModel, existing: dict) -> bool:
+    document = declared.document
+    keys = list(document["key"].items())
+
+    # Text indexes are stored under the internal _fts/_ftsx keys, so only their options compare
+    if TEXT not in dict(keys).values() and keys != [tuple(key) for key in existing["key"]]:
+        return False
+
+    return all(document.get(option) == existing.get(option) for option in INDEX_OPTIONS)
+
+
+def diff(model) -> IndexDiff:
+    declared = declared_indexes(model)
+    existing = existing_indexes(model)
+
+    return IndexDiff(
+        missing=[name for name in declared if name not in existing],
+        changed=[
+            name
+            for name, index in declared.items()
+            if name in existing and not _matches(index, existing[name])
+        ],
+        extra=[name for name in existing if name not in declared],
+    )
+
+
+def sync(model, drop: bool = False) -> IndexDiff:
+    # Since MongoDB 4.2 every build takes the exclusive lock only briefly at its start and
+    # end, so new indexes are built while the collection keeps serving reads and writes.
+    declared = declared_indexes(model)
+    collection = model.get_motor_collection()
+    result = diff(model)
+
+    to_create = list(result.missing)
+    if drop:
+        for name in result.changed + result.extra:
+            collection.drop_index(name)
+        to_create += result.changed
+
+    if to_create:
+        collection.create_indexes([declared[name] for name in to_create])
+
+    return result
+
+
+class _Initializer(Initializer):
+    # bunnet builds every declared index in the foreground on init; that is left to
+    # `flask indexes sync`, so a slow or failing build cannot block app startup
+    @staticmethod
+    def init_indexes(cls, allow_index_dropping: bool = False):
+        pass
+
+
+def init_models(database, document_models: list):
+    _Initializer(database=database, document_models=document_models).run()
+
+
+def check(document_models: list):
+    for model in document_models:
+        result = diff(model)
+        if result.missing or result.changed:
+            logger.warning(
+                "%s indexes differ from the declared ones (missing: %s, changed: %s), "
+                "run `flask indexes sync`",
+                model.__name__,
+                ", ".join(result.missing) or "-",
+                ", ".join(result.changed) or "-",
+            )
@@ -1,11 +1,24 @@
+from flask import abort
 from flask import Blueprint
 from flask import redirect
 from flask import render_template
+from flask import request
+from flask import Response
 from flask import url_for
 from flask_login import current_user
+from flask_login import login_required
+
+from library.auth.decorators import admin_role_required
+from library.auth.models import user_cache
+from library.exports import export
+from library.exports import EXPORTS
+from library.exports import FORMATS
+from library.metrics import command_metrics
 
 main = Blueprint("main", __name__)
 
+EXPORT_MIMETYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
 
 @main.route("/")
 @main.route("/home")
@@ -14,3 +27,39 @@ def home():
         return redirect(url_for("auth.login"))
 
     return render_template("home.html")
+
+
+@main.route("/metrics")
+def metrics():
+    cache = user_cache.stats()
+    body = command_metrics.render() + (
+        "# HELP user_cache_hits_total Logged-in user lookups served from the cache.\n"
+        "# TYPE user_cache_hits_total counter\n"
+        f"user_cache_hits_total {cache['hits']}\n"
+        "# HELP user_cache_misses_total Logged-in user lookups that read the database.\n"
+        "# TYPE user_cache_misses_total counter\n"
+        f"user_cache_misses_total {cache['misses']}\n"
+        "# HELP user_cache_size Users currently held in the cache.\n"
+        "# TYPE user_cache_size gauge\n"
+        f"user_cache_size {cache['size']}\n"
+    )
+
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+@main.route("/exports/<name>.<file_format>")
+@login_required
+@admin_role_required
+def export_collection(name, file_format):
+    if name not in EXPORTS or file_format not in FORMATS:
+        abort(404)
+
+    compress = request.args.get("gzip", False, type=bool)
+    filename = f"{name}.{file_format}{'.gz' if compress else ''}"
+    mimetype = "application/gzip" if compress else EXPORT_MIMETYPES[file_format]
+
+    return Response(
+        export(name, file_format, compress=compress),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
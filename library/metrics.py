@@ -0,0 +1,153 @@
+import bisect
+import random
+import threading
+from collections import defaultdict
+
+import bson
+from flask import has_request_context
+from flask import request
+from pymongo import monitoring
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+BYTES_BUCKETS = tuple(256 * 4**i for i in range(9))
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield bound, total
+
+
+def current_endpoint() -> str:
+    if has_request_context():
+        return request.endpoint or "unmatched"
+    return "none"
+
+
+def _labels(**labels) -> str:
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class CommandMetrics(monitoring.CommandListener):
+    # Command events are published on the thread running the operation, so the Flask
+    # request context of the view that issued the command is still active in started().
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.requests = defaultdict(int)
+        self.commands = defaultdict(int)
+        self.failures = defaultdict(int)
+        self.durations = defaultdict(lambda: Histogram(DURATION_BUCKETS))
+        self.request_bytes = defaultdict(lambda: Histogram(BYTES_BUCKETS))
+        self.reply_bytes = defaultdict(lambda: Histogram(BYTES_BUCKETS))
+        # Share of commands whose request and reply are re-encoded to measure their size;
+        # encoding a large reply costs about as much as decoding it, so this is off by default
+        self.bytes_sample_rate = 0.0
+
+    def observe_request(self, endpoint: str):
+        with self._lock:
+            self.requests[endpoint] += 1
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        collection = target if isinstance(target, str) else event.command.get("collection", "")
+        key = (current_endpoint(), collection, event.command_name)
+
+        sampled = self.bytes_sample_rate > 0 and random.random() < self.bytes_sample_rate
+        self._pending[(event.connection_id, event.request_id)] = key, sampled
+        if sampled:
+            size = len(bson.encode(event.command))
+            with self._lock:
+                self.request_bytes[key].observe(size)
+
+    def succeeded(self, event):
+        key, sampled = self._pending.pop((event.connection_id, event.request_id), (None, False))
+        if key is None:
+            return
+
+        size = len(bson.encode(event.reply)) if sampled else None
+        with self._lock:
+            self.commands[key] += 1
+            self.durations[key].observe(event.duration_micros / 1e6)
+            if sampled:
+                self.reply_bytes[key].observe(size)
+
+    def failed(self, event):
+        key, _ = self._pending.pop((event.connection_id, event.request_id), (None, False))
+        if key is None:
+            return
+
+        with self._lock:
+            self.commands[key] += 1
+            self.failures[key] += 1
+            self.durations[key].observe(event.duration_micros / 1e6)
+
+    def render(self) -> str:
+        lines = []
+
+        def counter(name, description, values, label_names):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(values.items()):
+                if isinstance(key, str):
+                    key = (key,)
+                lines.append(f"{name}{_labels(**dict(zip(label_names, key)))} {value}")
+
+        def histogram(name, description, values):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} histogram")
+            for (endpoint, collection, command), value in sorted(values.items()):
+                labels = {"endpoint": endpoint, "collection": collection, "command": command}
+                for bound, count in value.cumulative():
+                    lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {count}")
+                lines.append(f"{name}_sum{_labels(**labels)} {value.sum}")
+                lines.append(f"{name}_count{_labels(**labels)} {sum(value.counts)}")
+
+        command_labels = ("endpoint", "collection", "command")
+        with self._lock:
+            counter("flask_requests_total", "Handled requests.", self.requests, ("endpoint",))
+            counter(
+                "mongodb_commands_total",
+                "MongoDB commands sent.",
+                self.commands,
+                command_labels,
+            )
+            counter(
+                "mongodb_command_failures_total",
+                "MongoDB commands that failed.",
+                self.failures,
+                command_labels,
+            )
+            histogram(
+                "mongodb_command_duration_seconds", "MongoDB command latency.", self.durations
+            )
+            histogram(
+                "mongodb_command_request_bytes",
+                "Size of a sample of the sent commands.",
+                self.request_bytes,
+            )
+            histogram(
+                "mongodb_command_reply_bytes",
+                "Size of a sample of the replies.",
+                self.reply_bytes,
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+command_metrics = CommandMetrics()
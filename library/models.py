@@ -0,0 +1,23 @@
+from library.auth.models import User
+from library.books.models import Author
+from library.books.models import Book
+from library.books.models import BookRecommendations
+from library.books.models import CirculationStats
+from library.books.models import CoRent
+from library.books.models import OverdueRent
+from library.books.models import RecommendationRun
+from library.books.models import Rent
+from library.books.models import Review
+
+document_models = [
+    Book,
+    User,
+    Rent,
+    Review,
+    OverdueRent,
+    CirculationStats,
+    CoRent,
+    BookRecommendations,
+    RecommendationRun,
+    Author,
+]
@@ -0,0 +1,282 @@
+import base64
+import binascii
+import math
+
+from bson import json_util
+from bunnet.odm.enums import SortDirection
+from bunnet.odm.utils.find import construct_lookup_queries
+from bunnet.odm.utils.parsing import parse_obj
+from bunnet.odm.utils.projection import get_projection
+from flask import abort
+
+from library.utils import datetime_encoders
+
+LAST_PAGE = "last"
+# Cursor pages count at most this many matches; the pager then shows "1000+ results"
+TOTAL_LIMIT = 1000
+
+
+def encode_cursor(keys: list[str], values: list) -> str:
+    values = [datetime_encoders.get(type(value), lambda x: x)(value) for value in values]
+    payload = json_util.dumps({"k": keys, "v": values}).encode()
+
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(keys: list[str], token: str) -> list:
+    try:
+        payload = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        cursor = json_util.loads(payload)
+    except (binascii.Error, ValueError):
+        raise abort(400)
+
+    if not isinstance(cursor, dict) or cursor.get("k") != keys:
+        raise abort(400)
+
+    return cursor["v"]
+
+
+def _sort_keys(query) -> list[tuple[str, SortDirection]]:
+    sort = [(str(key), direction) for key, direction in query.sort_expressions]
+    if not any(key == "_id" for key, _ in sort):
+        direction = sort[0][1] if sort else SortDirection.ASCENDING
+        sort.append(("_id", direction))
+
+    return sort
+
+
+def _reverse(sort: list[tuple[str, SortDirection]]) -> list[tuple[str, SortDirection]]:
+    return [
+        (key, SortDirection.DESCENDING)
+        if direction == SortDirection.ASCENDING
+        else (key, SortDirection.ASCENDING)
+        for key, direction in sort
+    ]
+
+
+def _seek_filter(sort: list[tuple[str, SortDirection]], values: list) -> dict:
+    # (a, b) > (x, y)  <=>  a >= x AND (a > x OR (a == x AND b > y)); the leading
+    # range on the first key keeps the index scan bounded.
+    first_key, first_direction = sort[0]
+    first_op = "$gte" if first_direction == SortDirection.ASCENDING else "$lte"
+
+    clauses = []
+    for i, (key, direction) in enumerate(sort):
+        clause = {prev_key: values[j] for j, (prev_key, _) in enumerate(sort[:i])}
+        clause[key] = {"$gt" if direction == SortDirection.ASCENDING else "$lt": values[i]}
+        clauses.append(clause)
+
+    return {first_key: {first_op: values[0]}, "$or": clauses}
+
+
+def _sort_value(item, key: str):
+    if isinstance(item, dict):
+        value = item
+        for part in key.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        return value
+
+    if key == "_id":
+        return item.id
+
+    value = item
+    for part in key.split("."):
+        value = getattr(value, part)
+
+    return value
+
+
+def _filter(query) -> dict:
+    # The filter has to be taken before link fields are resolved, so it can run first
+    # and use the indexes; bunnet would otherwise $lookup every document before matching.
+    plain = query.clone()
+    plain.fetch_links = False
+    return plain.get_filter_query()
+
+
+def _shape_stages(query, projection: dict = None) -> list[dict]:
+    stages = []
+    if query.fetch_links:
+        stages += construct_lookup_queries(query.document_model)
+    # A projection model may join just the fields it shows instead of whole linked documents
+    if hasattr(query.projection_model, "lookup_stages"):
+        stages += query.projection_model.lookup_stages()
+    # An explicit projection returns the raw documents, for callers that encode them as-is
+    if projection is None:
+        projection = get_projection(query.projection_model)
+    if projection:
+        stages.append({"$project": projection})
+
+    return stages
+
+
+def _parse(query, documents: list[dict], projection: dict = None) -> list:
+    if projection is not None:
+        return documents
+
+    return [parse_obj(query.projection_model, document) for document in documents]
+
+
+def fetch_page(query, skip: int = 0, limit: int = 0, projection: dict = None):
+    match = _filter(query)
+    sort = {key: direction for key, direction in query.sort_expressions}
+
+    page = []
+    if skip:
+        page.append({"$skip": skip})
+    if limit:
+        page.append({"$limit": limit})
+    page += _shape_stages(query, projection)
+
+    head = [{"$sort": sort}] if sort else []
+    collection = query.document_model.get_motor_collection()
+
+    # An offset page has to walk past the skipped documents anyway, so the total comes
+    # back from the same aggregation.
+    if match:
+        pipeline = [
+            {"$match": match},
+            *head,
+            {"$facet": {"items": page, "total": [{"$count": "count"}]}},
+        ]
+        result = next(collection.aggregate(pipeline, session=query.session))
+        documents = result["items"]
+        total = result["total"][0]["count"] if result["total"] else 0
+    else:
+        documents = list(collection.aggregate(head + page, session=query.session))
+        total = collection.estimated_document_count()
+
+    return _parse(query, documents, projection), total
+
+
+def fetch_seek_page(query, seek: dict = None, limit: int = 0, projection: dict = None):
+    # The seek goes into the leading $match, so the index range starts at the cursor and
+    # $sort + $limit read just one page; inside a $facet none of that could use an index.
+    match = _filter(query)
+    if seek:
+        match = {"$and": [match, seek]} if match else seek
+    sort = {key: direction for key, direction in query.sort_expressions}
+
+    pipeline = [{"$match": match}] if match else []
+    if sort:
+        pipeline.append({"$sort": sort})
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline += _shape_stages(query, projection)
+
+    collection = query.document_model.get_motor_collection()
+    documents = list(collection.aggregate(pipeline, session=query.session))
+
+    return _parse(query, documents, projection)
+
+
+def count_matches(query) -> tuple[int, bool]:
+    match = _filter(query)
+    collection = query.document_model.get_motor_collection()
+
+    if not match:
+        return collection.estimated_document_count(), False
+
+    # Stops after TOTAL_LIMIT matches, so a broad filter does not read every document
+    # on every page just to print how many there are
+    total = collection.count_documents(match, limit=TOTAL_LIMIT + 1, session=query.session)
+
+    return min(total, TOTAL_LIMIT), total > TOTAL_LIMIT
+
+
+def count_facets(query, facets: dict) -> dict:
+    # Facets count every match, so they are kept out of the page queries and callers are
+    # expected to cache them
+    match = _filter(query)
+    pipeline = [*([{"$match": match}] if match else []), {"$facet": facets}]
+    collection = query.document_model.get_motor_collection()
+
+    return next(collection.aggregate(pipeline, session=query.session))
+
+
+def paginate_offset(query, page: int, page_size: int, projection: dict = None):
+    items, total = fetch_page(
+        query, skip=(page - 1) * page_size, limit=page_size, projection=projection
+    )
+
+    pagination = {
+        "mode": "offset",
+        "page": page,
+        "page_size": page_size,
+        "total": total,
+        "total_pages": math.ceil(total / page_size),
+    }
+
+    return items, pagination
+
+
+def paginate_keyset(
+    query,
+    page_size: int,
+    after: str = None,
+    before: str = None,
+    projection: dict = None,
+):
+    sort = _sort_keys(query)
+    keys = [key for key, _ in sort]
+
+    backwards = before is not None
+    token = before if backwards else after
+    query.sort_expressions = _reverse(sort) if backwards else sort
+
+    seek = None
+    if token and token != LAST_PAGE:
+        values = decode_cursor(keys, token)
+        if len(values) != len(sort):
+            raise abort(400)
+        seek = _seek_filter(query.sort_expressions, values)
+
+    if projection:
+        # The next cursor is built from the sort keys, so they have to come back too
+        projection = {**projection, **{key: 1 for key in keys}}
+    items = fetch_seek_page(query, seek=seek, limit=page_size + 1, projection=projection)
+    total, capped = count_matches(query)
+    has_more = len(items) > page_size
+    items = items[:page_size]
+
+    def cursor(item):
+        return encode_cursor(keys, [_sort_value(item, key) for key in keys])
+
+    if backwards:
+        items.reverse()
+        prev_token = cursor(items[0]) if items and has_more else None
+        next_token = cursor(items[-1]) if items and before != LAST_PAGE else None
+    else:
+        prev_token = cursor(items[0]) if items and after else None
+        next_token = cursor(items[-1]) if items and has_more else None
+
+    pagination = {
+        "mode": "cursor",
+        "page_size": page_size,
+        "total": total,
+        "capped": capped,
+        "prev": prev_token,
+        "next": next_token,
+        "last": LAST_PAGE,
+    }
+
+    return items, pagination
+
+
+def is_seekable(query) -> bool:
+    # Computed sort keys (e.g. {"$meta": "textScore"}) cannot be used in a range filter
+    return all(isinstance(direction, int) for _, direction in query.sort_expressions)
+
+
+def paginate(
+    query,
+    page_size: int,
+    page: int = None,
+    after: str = None,
+    before: str = None,
+    projection: dict = None,
+):
+    if page or not is_seekable(query):
+        return paginate_offset(query, page or 1, page_size, projection=projection)
+
+    return paginate_keyset(query, page_size, after=after, before=before, projection=projection)
@@ -0,0 +1,167 @@
+import json
+from collections import Counter
+
+from bson import json_util
+from flask import current_app
+from flask import g
+from flask import has_request_context
+from flask import request
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+REPEATED_QUERY_THRESHOLD = 3
+IGNORED_COMMANDS = {
+    "getMore",
+    "killCursors",
+    "endSessions",
+    "commitTransaction",
+    "abortTransaction",
+}
+EXPLAINABLE_COMMANDS = {
+    "find",
+    "aggregate",
+    "count",
+    "distinct",
+    "update",
+    "delete",
+    "findAndModify",
+}
+SESSION_FIELDS = {
+    "lsid",
+    "txnNumber",
+    "autocommit",
+    "startTransaction",
+    "readConcern",
+    "writeConcern",
+}
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(limit: int):
+    # Goes right under @route, outside login_required and friends, so the attribute is set
+    # on the function Flask registers for the endpoint, where report_queries looks it up
+    def decorator(view):
+        view.query_budget = limit
+        return view
+
+    return decorator
+
+
+def _shape(value):
+    if isinstance(value, dict):
+        return {key: _shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        shapes = [_shape(item) for item in value]
+        # $in lists of different lengths still describe the same query
+        return shapes[:1] if all(shape == shapes[0] for shape in shapes) else shapes
+    return "?"
+
+
+def _strip(command: dict) -> dict:
+    return {
+        key: value
+        for key, value in command.items()
+        if key not in SESSION_FIELDS and not key.startswith("$")
+    }
+
+
+class ProfiledQuery:
+    def __init__(self, event):
+        command = _strip(event.command)
+        target = command.pop(event.command_name, None)
+        command.pop("documents", None)
+
+        self.database = event.database_name
+        self.command_name = event.command_name
+        self.command = event.command if event.command_name in EXPLAINABLE_COMMANDS else None
+        self.shape = json.dumps(
+            {event.command_name: target if isinstance(target, str) else "?", **_shape(command)},
+            sort_keys=True,
+        )
+        self.duration_ms = None
+
+
+class QueryProfiler(monitoring.CommandListener):
+    def __init__(self):
+        self._pending = {}
+
+    @staticmethod
+    def _active() -> bool:
+        return (
+            has_request_context()
+            and current_app.config.get("QUERY_PROFILING", False)
+            and not g.get("explaining", False)
+        )
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS or not self._active():
+            return
+
+        query = ProfiledQuery(event)
+        g.setdefault("queries", []).append(query)
+        self._pending[(event.connection_id, event.request_id)] = query
+
+    def succeeded(self, event):
+        query = self._pending.pop((event.connection_id, event.request_id), None)
+        if query:
+            query.duration_ms = event.duration_micros / 1000
+
+    def failed(self, event):
+        self.succeeded(event)
+
+
+def explain(query: ProfiledQuery) -> str:
+    from library import mongo_client
+
+    g.explaining = True
+    try:
+        result = mongo_client[query.database].command(
+            {"explain": _strip(query.command), "verbosity": "queryPlanner"}
+        )
+    except PyMongoError as error:
+        return f"explain failed: {error}"
+    finally:
+        g.explaining = False
+
+    return json_util.dumps(result.get("queryPlanner", {}).get("winningPlan", result))
+
+
+def report_queries(response):
+    if not current_app.config.get("QUERY_PROFILING", False):
+        return response
+
+    queries = g.pop("queries", [])
+    logger = current_app.logger
+    view = f"{request.method} {request.path}"
+    response.headers["X-Query-Count"] = str(len(queries))
+
+    for shape, count in Counter(query.shape for query in queries).items():
+        if count >= REPEATED_QUERY_THRESHOLD:
+            logger.warning("Possible N+1 in %s: %d queries shaped %s", view, count, shape)
+
+    for query in queries:
+        if query.duration_ms and query.duration_ms >= current_app.config["SLOW_QUERY_MS"]:
+            plan = explain(query) if query.command else "-"
+            logger.warning(
+                "Slow query in %s (%.1f ms): %s\nwinning plan: %s",
+                view,
+                query.duration_ms,
+                query.shape,
+                plan,
+            )
+
+    view_function = current_app.view_functions.get(request.endpoint)
+    budget = getattr(view_function, "query_budget", None)
+    if budget is not None and len(queries) > budget:
+        message = f"{view} made {len(queries)} queries, its budget is {budget}"
+        if current_app.testing:
+            raise QueryBudgetExceeded(message)
+        logger.error(message)
+
+    return response
+
+
+query_profiler = QueryProfiler()
@@ -0,0 +1,89 @@
+import logging
+import random
+import time
+
+from pymongo.errors import PyMongoError
+
+from library import mongo_client
+
+MAX_ATTEMPTS = 5
+BASE_DELAY = 0.01
+MAX_DELAY = 1
+# The same limit ClientSession.with_transaction puts on retrying a commit
+COMMIT_TIMEOUT = 120
+
+logger = logging.getLogger(__name__)
+_after_commit = {}
+
+
+def _backoff(attempt: int) -> float:
+    return min(BASE_DELAY * 2**attempt, MAX_DELAY) * random.uniform(0.5, 1.5)
+
+
+def _commit(session):
+    deadline = time.monotonic() + COMMIT_TIMEOUT
+    attempt = 0
+    while True:
+        try:
+            session.commit_transaction()
+            return
+        except PyMongoError as error:
+            # The commit may have been applied; committing again is safe, re-running is not.
+            # A primary that stays unreachable must not hold the request forever, though.
+            if (
+                not error.has_error_label("UnknownTransactionCommitResult")
+                or time.monotonic() >= deadline
+            ):
+                raise
+
+        attempt += 1
+        time.sleep(min(_backoff(attempt), max(deadline - time.monotonic(), 0)))
+
+
+def after_commit(session, callback):
+    # For writes that must not join the transaction, e.g. increments of documents shared by
+    # every desk, which would make concurrent transactions conflict. Without a transaction
+    # the callback runs right away; a retried transaction drops those of the failed attempt.
+    if session is None or session not in _after_commit:
+        callback()
+    else:
+        _after_commit[session].append(callback)
+
+
+def _run_after_commit(callbacks: list):
+    # The transaction is already committed, so a failure here must not fail the request
+    for callback in callbacks:
+        try:
+            callback()
+        except PyMongoError:
+            logger.exception("Write after commit failed")
+
+
+def run_in_transaction(callback, max_attempts: int = MAX_ATTEMPTS):
+    # Unlike ClientSession.with_transaction, which retries write conflicts immediately,
+    # concurrent callers back off with jitter instead of aborting each other in a loop.
+    for attempt in range(1, max_attempts + 1):
+        with mongo_client.start_session() as session:
+            session.start_transaction()
+            _after_commit[session] = []
+            try:
+                result = callback(session)
+                _commit(session)
+                _run_after_commit(_after_commit.pop(session))
+                return result
+            except PyMongoError as error:
+                if session.in_transaction:
+                    session.abort_transaction()
+                if (
+                    not error.has_error_label("TransientTransactionError")
+                    or attempt == max_attempts
+                ):
+                    raise
+            except Exception:
+                if session.in_transaction:
+                    session.abort_transaction()
+                raise
+            finally:
+                _after_commit.pop(session, None)
+
+        time.sleep(_backoff(attempt))
@@ -1,5 +1,8 @@
 import datetime
 
+from bson import DBRef
+from bson import ObjectId
+
 
 def next_month_factory():
     today = datetime.date.today()
@@ -11,3 +14,13 @@ datetime_encoders = {
     datetime.date: lambda x: x.isoformat(),
     datetime.datetime: lambda x: x.isoformat(),
 }
+
+
+def json_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, DBRef):
+        return str(value.id)
+    if type(value) in datetime_encoders:
+        return datetime_encoders[type(value)](value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
@@ -1,20 +1,91 @@
+import datetime
+import itertools
+import multiprocessing
 import random
+import struct
+import time
+from collections import Counter
+from typing import NamedTuple
 
-from bunnet import PydanticObjectId
+import click
+from bson import ObjectId
 from faker import Faker
+from faker.providers.person.en_US import Provider as PersonProvider
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
+from library import bcrypt
 from library import create_app
 from library.auth.models import User
+from library.books.commands import update_ratings
+from library.books.models import Author
 from library.books.models import Book
 from library.books.models import BookGenre
+from library.books.models import BookRecommendations
+from library.books.models import CirculationStats
+from library.books.models import OPEN_RENT
+from library.books.models import OverdueRent
 from library.books.models import Rent
 from library.books.models import Review
+from library.indexes import sync
+from library.models import document_models
+
+DUPLICATE_KEY = 11000
+LOAN_DAYS = 30
+# Knuth's multiplicative hash constant; a prime, so rank * SCATTER % n is a permutation
+SCATTER = 2654435761
+ID_TIMESTAMP = int(datetime.datetime(2020, 1, 1).timestamp())
+ID_KINDS = {"user": 1, "book": 2, "rent": 3, "review": 4}
+RATING_WEIGHTS = [4, 6, 15, 35, 40]
+FIRST_NAMES = list(PersonProvider.first_names)
+FIRST_NAME_WEIGHTS = list(itertools.accumulate(PersonProvider.first_names.values()))
+LAST_NAMES = list(PersonProvider.last_names)
+LAST_NAME_WEIGHTS = list(itertools.accumulate(PersonProvider.last_names.values()))
 
 faker = Faker()
+options = None
+
+
+class Options(NamedTuple):
+    seed: int
+    users: int
+    books: int
+    rents: int
+    popularity_skew: float
+    activity_skew: float
+    open_ratio: float
+    overdue_ratio: float
+    review_ratio: float
+    history_days: int
+    password_hash: str
+    today: datetime.date
+
+
+def object_id(kind: str, index: int) -> ObjectId:
+    # Ids follow from the position alone, so a worker can link rents to books and users
+    # generated by other workers, and re-running with the same sizes skips existing ones.
+    return ObjectId(struct.pack(">IBxxxI", ID_TIMESTAMP, ID_KINDS[kind], index))
+
 
+def skewed_index(rng: random.Random, n: int, skew: float) -> int:
+    # skew=1 is uniform; higher values put most draws on a few items (a power law), which
+    # are then scattered over the whole id range so popular books are not all the oldest.
+    rank = int(n * rng.random() ** skew)
+    return rank * SCATTER % n
 
-def generate_isbn():
-    return f"{random.randint(1000000000, 9999999999)}"
+
+def author_name(index: int) -> str:
+    rng = random.Random(f"{options.seed}:author:{index}")
+    first_name = rng.choices(FIRST_NAMES, cum_weights=FIRST_NAME_WEIGHTS)[0]
+    last_name = rng.choices(LAST_NAMES, cum_weights=LAST_NAME_WEIGHTS)[0]
+
+    return f"{first_name} {last_name}"
+
+
+def history_start() -> datetime.date:
+    # Relative to options.today rather than the clock, so every worker shares one day and
+    # the same --seed and --today give the same dates
+    return options.today - datetime.timedelta(days=options.history_days)
 
 
 def generate_sample_addresses():
@@ -26,81 +97,300 @@ def generate_sample_addresses():
     }
 
 
-def populate_db():
-    users = []
-    for _ in range(100):
-        user = User(
+def make_users(rng: random.Random, start: int, stop: int):
+    for i in range(start, stop):
+        yield User(
+            id=object_id("user", i),
             first_name=faker.first_name(),
             last_name=faker.last_name(),
-            email=faker.email(),
-            phone_number=faker.phone_number(),
-            password=faker.password(),
+            email=f"user{i}@example.com",
+            phone_number=f"+48{i:09d}",
+            password=options.password_hash,
             address=generate_sample_addresses(),
-            is_admin=faker.boolean(20),
+            is_admin=i == 0 or rng.random() < 0.01,
+            created_at=faker.date_time_between(
+                start_date=history_start(), end_date=options.today
+            ),
         )
-        users.append(user)
 
-    user_ids = User.insert_many(users).inserted_ids  # type: ignore
 
-    books = []
-    for _ in range(1000):
-        stock = faker.random_int(1, 50)
-        book = Book(
-            title=faker.sentence(),
-            authors=[faker.name() for _ in range(random.randint(1, 2))],
+def make_books(rng: random.Random, start: int, stop: int):
+    authors = max(options.books // 3, 1)
+
+    for i in range(start, stop):
+        stock = rng.randint(1, 20)
+        created_at = faker.date_time_between(start_date=history_start(), end_date=options.today)
+        yield Book(
+            id=object_id("book", i),
+            title=faker.sentence(nb_words=rng.randint(2, 6)).rstrip("."),
+            authors=[
+                author_name(skewed_index(rng, authors, options.popularity_skew))
+                for _ in range(rng.choices([1, 2, 3], [80, 17, 3])[0])
+            ],
             topic=faker.word(),
-            genre=random.choice(list(BookGenre)).value,
-            publication_date=faker.date_between(start_date="-30y", end_date="today"),
+            genre=rng.choice(list(BookGenre)).value,
+            publication_date=faker.date_between(
+                start_date=options.today - datetime.timedelta(days=30 * 365),
+                end_date=options.today,
+            ),
             publisher=faker.company(),
             description=faker.text(),
-            isbn=generate_isbn(),
-            pages=faker.random_int(100, 1000),
+            isbn=f"978{i:010d}",
+            pages=rng.randint(100, 1000),
             stock=stock,
-            initial_stock=stock + 5,
-            images_urls=[faker.image_url() for _ in range(random.randint(1, 3))],
-            created_at=faker.date_time_this_year(),
-            updated_at=faker.date_time_this_year(),
+            initial_stock=stock,
+            images_urls=[faker.image_url() for _ in range(rng.randint(1, 3))],
+            created_at=created_at,
+            updated_at=created_at,
         )
-        books.append(book)
-
-    books_ids = Book.insert_many(books).inserted_ids  # type: ignore
-
-    rents = []
-    reviews = []
-    for _ in range(500):
-        i = random.randint(0, len(books_ids) - 1)
-        book = books[i]
-        book_id = books_ids[i]
-        book.id = book_id
-        j = random.randint(0, len(user_ids) - 1)
-        user = users[j]
-        user_id = user_ids[j]
-        user.id = user_id
-        rent = Rent(
-            book=book,
-            user=user,
-            rent_date=faker.date_between(start_date="-2m", end_date="today"),
-            due_date=faker.date_between(start_date="-5d", end_date="+15d"),
-            return_date=faker.date_between(start_date="-2d", end_date="+12d")
-            if faker.boolean(70)
-            else None,
+
+
+def make_rents(rng: random.Random, start: int, stop: int):
+    today = options.today
+
+    for i in range(start, stop):
+        book_id = object_id("book", skewed_index(rng, options.books, options.popularity_skew))
+        user_id = object_id("user", skewed_index(rng, options.users, options.activity_skew))
+        state = rng.random()
+
+        if state < options.open_ratio * options.overdue_ratio:
+            rent_date = today - datetime.timedelta(
+                days=rng.randint(LOAN_DAYS + 1, LOAN_DAYS + 90)
+            )
+            return_date = None
+        elif state < options.open_ratio:
+            rent_date = today - datetime.timedelta(days=rng.randint(0, LOAN_DAYS))
+            return_date = None
+        else:
+            rent_date = today - datetime.timedelta(days=rng.randint(1, options.history_days))
+            return_date = min(
+                rent_date + datetime.timedelta(days=rng.randint(1, LOAN_DAYS + 10)), today
+            )
+
+        yield Rent(
+            id=object_id("rent", i),
+            book=Book.link_from_id(book_id),
+            user=User.link_from_id(user_id),
+            rent_date=rent_date,
+            due_date=rent_date + datetime.timedelta(days=LOAN_DAYS),
+            return_date=return_date,
         )
-        rents.append(rent)
-
-        if rent.return_date:
-            review = Review(
-                book_id=PydanticObjectId(book_id),
-                user=user,
-                rating=random.randint(1, 5),
-                comment=faker.text(),
+
+        if return_date and rng.random() < options.review_ratio:
+            yield Review(
+                id=object_id("review", i),
+                book_id=book_id,
+                user=User.link_from_id(user_id),
+                rating=rng.choices(range(1, 6), RATING_WEIGHTS)[0],
+                comment=faker.paragraph(),
+                created_at=datetime.datetime.combine(
+                    return_date, datetime.time(rng.randint(8, 21), rng.randint(0, 59))
+                ),
             )
 
-            reviews.append(review)
 
-    Rent.insert_many(rents)  # type: ignore
-    Review.insert_many(reviews)  # type: ignore
+def insert(model, documents: list) -> int:
+    if not documents:
+        return 0
+
+    try:
+        return len(model.insert_many(documents, ordered=False).inserted_ids)
+    except BulkWriteError as error:
+        # Skewed draws can repeat a book and member pair, which open_rents_unique and the
+        # review index reject; those documents are simply left out.
+        if any(
+            write_error["code"] != DUPLICATE_KEY for write_error in error.details["writeErrors"]
+        ):
+            raise
+        return error.details["nInserted"]
+
+
+GENERATORS = {"users": make_users, "books": make_books, "rents": make_rents}
+
+
+def init_worker(worker_options: Options):
+    global options
+    options = worker_options
+    # Following the books change stream during a bulk load would only slow it down
+    create_app(typeahead=False)
+
+
+def generate(task: tuple[str, int, int]) -> Counter:
+    kind, start, stop = task
+    if kind == "ratings":
+        update_ratings([object_id("book", i) for i in range(start, stop)])
+        return Counter(books=stop - start)
+
+    # Every batch has its own seed, so the data does not depend on the number of workers
+    rng = random.Random(f"{options.seed}:{kind}:{start}")
+    faker.seed_instance(f"{options.seed}:{kind}:{start}")
+
+    documents = {}
+    for document in GENERATORS[kind](rng, start, stop):
+        documents.setdefault(type(document), []).append(document)
+
+    return Counter({model.__name__: insert(model, batch) for model, batch in documents.items()})
+
+
+def run(pool, kind: str, total: int, batch_size: int):
+    started = time.monotonic()
+    tasks = [
+        (kind, start, min(start + batch_size, total)) for start in range(0, total, batch_size)
+    ]
+    results = pool.imap_unordered(generate, tasks) if pool else map(generate, tasks)
+
+    done = Counter()
+    for counts in results:
+        done += counts
+        click.echo(f"\r{kind}: {_format_counts(done)}", nl=False)
+
+    elapsed = time.monotonic() - started
+    rate = sum(done.values()) / max(elapsed, 1e-9)
+    click.echo(f"\r{kind}: {_format_counts(done)} in {elapsed:.1f}s ({rate:.0f} documents/s)")
+
+
+def _format_counts(counts: Counter) -> str:
+    return ", ".join(f"{count} {name}" for name, count in sorted(counts.items()))
+
+
+def update_stock(batch_size: int):
+    # Stock is what is left after the open rents; popular books get more copies if needed
+    open_rents = Counter(
+        rent["book"].id
+        for rent in Rent.get_motor_collection()
+        .find(OPEN_RENT, {"book": 1})
+        .batch_size(batch_size)
+    )
+    collection = Book.get_motor_collection()
+    book_ids = list(open_rents)
+
+    for start in range(0, len(book_ids), batch_size):
+        books = collection.find(
+            {"_id": {"$in": book_ids[start : start + batch_size]}}, {"initial_stock": 1}
+        )
+        collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": book["_id"]},
+                    {
+                        "$set": {
+                            "initial_stock": max(
+                                book["initial_stock"], open_rents[book["_id"]]
+                            ),
+                            "stock": max(book["initial_stock"] - open_rents[book["_id"]], 0),
+                        }
+                    },
+                )
+                for book in books
+            ],
+            ordered=False,
+        )
+
+
+@click.command()
+@click.option("--users", default=100, show_default=True)
+@click.option("--books", default=1000, show_default=True)
+@click.option("--rents", default=500, show_default=True)
+@click.option("--seed", default=0, show_default=True)
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option("--workers", default=1, show_default=True)
+@click.option(
+    "--popularity-skew",
+    default=2.0,
+    show_default=True,
+    help="1 draws books uniformly, higher values concentrate rents on fewer books.",
+)
+@click.option(
+    "--activity-skew",
+    default=1.5,
+    show_default=True,
+    help="Same as --popularity-skew, for members.",
+)
+@click.option("--open-ratio", default=0.05, show_default=True, help="Share of rents still out.")
+@click.option(
+    "--overdue-ratio", default=0.2, show_default=True, help="Share of open rents past due."
+)
+@click.option(
+    "--review-ratio", default=0.3, show_default=True, help="Share of returns that get a review."
+)
+@click.option("--history-days", default=730, show_default=True)
+@click.option(
+    "--today",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    help="Last day of the generated history, defaults to the current date.",
+)
+@click.option(
+    "--password", default="password", show_default=True, help="Password of every member."
+)
+@click.option("--drop", is_flag=True, help="Drop the collections before generating.")
+def populate_db(
+    users,
+    books,
+    rents,
+    seed,
+    batch_size,
+    workers,
+    popularity_skew,
+    activity_skew,
+    open_ratio,
+    overdue_ratio,
+    review_ratio,
+    history_days,
+    today,
+    password,
+    drop,
+):
+    """Generate a synthetic dataset; member N logs in as userN@example.com (user0 is an admin)."""
+    create_app(typeahead=False)
+
+    if drop:
+        for model in [User, Book, Rent, Review, OverdueRent]:
+            model.get_motor_collection().drop()
+    # The app does not build indexes on start, and the unique ones back the $merge steps
+    for model in document_models:
+        sync(model)
+
+    worker_options = Options(
+        seed=seed,
+        users=users,
+        books=books,
+        rents=rents,
+        popularity_skew=popularity_skew,
+        activity_skew=activity_skew,
+        open_ratio=open_ratio,
+        overdue_ratio=overdue_ratio,
+        review_ratio=review_ratio,
+        history_days=history_days,
+        # Hashed once: bcrypt is deliberately slow and would dominate the run
+        password_hash=bcrypt.generate_password_hash(password).decode("utf-8"),
+        today=today.date() if today else datetime.date.today(),
+    )
+
+    # Spawned workers open their own MongoClient; pymongo clients are not fork-safe
+    pool = None
+    if workers > 1:
+        context = multiprocessing.get_context("spawn")
+        pool = context.Pool(workers, initializer=init_worker, initargs=(worker_options,))
+    else:
+        global options
+        options = worker_options
+
+    try:
+        run(pool, "users", users, batch_size)
+        run(pool, "books", books, batch_size)
+        run(pool, "rents", rents, batch_size)
+        run(pool, "ratings", books, batch_size)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    update_stock(batch_size)
+    click.echo(f"overdue: {OverdueRent.sweep()}")
+    click.echo(f"authors: {Author.rebuild(batch_size)}")
+    click.echo(f"circulation rollups: {CirculationStats.backfill()}")
+    click.echo(f"recommendations: {BookRecommendations.refresh(full=True).books}")
 
 
 if __name__ == "__main__":
-    create_app()
     populate_db()